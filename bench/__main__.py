@@ -0,0 +1,67 @@
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from os import environ, path
+import platform
+import logging
+import sqlite3
+import json
+
+from bench.seed import seed
+from bench.queries import bench_queries
+from bench.handlers import bench_handlers
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Seed a db and report throughput and p50/p99 latency of the "
+        "slack handlers and every db function as json"
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--emojis", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--reactions", type=int, default=100000)
+    parser.add_argument("--calls", type=int, default=200, help="per db function")
+    parser.add_argument("--events", type=int, default=500, help="per handler")
+    parser.add_argument("--rate", type=float, default=100, help="events per second")
+    parser.add_argument("--workers", type=int, default=10, help="handler threads")
+    parser.add_argument("--out", help="write results here instead of stdout")
+    args = parser.parse_args(argv)
+    sizes = {
+        "users": args.users,
+        "emojis": args.emojis,
+        "channels": args.channels,
+        "messages": args.messages,
+    }
+    with TemporaryDirectory() as tmp:
+        name = path.join(tmp, "bench.db")
+        seed(name, reactions=args.reactions, **sizes)
+        queries = bench_queries(name, args.calls)
+        # emoji_atlas builds its db and caches on import, point it at the seed
+        environ["db_file"] = name
+        import emoji_atlas
+
+        logging.disable(logging.INFO)
+        handlers = bench_handlers(
+            emoji_atlas, args.events, args.rate, args.workers, **sizes
+        )
+        emoji_atlas.database.close()
+    results = {
+        "python": {
+            "implementation": platform.python_implementation(),
+            "version": platform.python_version(),
+        },
+        "sqlite": sqlite3.sqlite_version,
+        "config": vars(args),
+        "handlers": handlers,
+        "queries": queries,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
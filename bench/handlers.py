@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+import logging
+
+from bench.seed import base_ts, message, user_name, emoji_name, channel_name
+from bench.stats import summary
+
+logger = logging.getLogger("bench")
+context = {"team_id": "T00000000"}
+
+
+class StubClient:
+    # answers the slack web api calls the handlers make from the seeded data
+    def __init__(self, users, channels):
+        self.users = users
+        self.channels = channels
+
+    def conversations_history(self, channel, inclusive, oldest, limit):
+        i = int(float(oldest) - base_ts)
+        return {"messages": [message(i, self.users, self.channels)]}
+
+    def views_open(self, trigger_id, view):
+        return {"ok": True}
+
+    def views_publish(self, user_id, view):
+        return {"ok": True}
+
+
+def ack():
+    pass
+
+
+def handler_calls(atlas, client, users, emojis, messages, channels):
+    def reaction(i):
+        m = message(i * 7919 % messages, users, channels)
+        body = {
+            "event": {
+                "reaction": emoji_name(i % emojis),
+                "user": user_name(i % users),
+                "event_ts": str(base_ts + messages + i),
+                "item": {"type": "message", "channel": m["channel"], "ts": m["ts"]},
+            }
+        }
+        # the ingest queue would make this measure only the enqueue
+        atlas.process_reaction(context["team_id"], i % 10 == 0, logger, body, client)
+
+    def emoji_changed(i):
+        event = (
+            {"subtype": "add", "name": f"bench_{i}", "event_ts": str(base_ts + i)}
+            if i % 2 == 0
+            else {
+                "subtype": "rename",
+                "old_name": f"bench_{i - 1}",
+                "new_name": f"bench_{i}",
+            }
+        )
+        atlas.emoji_changed(logger, ack, event, context)
+
+    def emote(i):
+        m = message(i % messages, users, channels)
+        shortcut = {
+            "message": {"text": m["text"], "ts": m["ts"]},
+            "channel": {"id": m["channel"]},
+            "trigger_id": f"trigger_{i}",
+        }
+        atlas.emote(client, logger, ack, shortcut, context)
+
+    def top_emojis(i):
+        text = f"<@{user_name(i % users)}>"
+        if i % 2:
+            text += f" <#{channel_name(i % channels)}>"
+        if i % 3 == 0:
+            text += " 7d"
+        command = {"text": text, "trigger_id": f"trigger_{i}"}
+        atlas.show_user_top_emoji(ack, logger, command, client, context)
+
+    def home_tab(i):
+        atlas.home_tab(client, {"user": user_name(i % users)}, logger, context)
+
+    return {
+        "reaction_event": reaction,
+        "emoji_changed": emoji_changed,
+        "emote": emote,
+        "show_user_top_emoji": top_emojis,
+        "home_tab": home_tab,
+    }
+
+
+def drive(call, count, rate, workers):
+    # calls are issued at a fixed rate, latency includes waiting for a worker
+    # like a burst of events queueing for bolt's handler threads
+    def timed(i, scheduled):
+        call(i)
+        return perf_counter() - scheduled
+
+    with ThreadPoolExecutor(workers) as pool:
+        begin = perf_counter()
+        futures = []
+        for i in range(count):
+            scheduled = begin + i / rate
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            futures.append(pool.submit(timed, i, scheduled))
+        latencies = [future.result() for future in futures]
+        return summary(latencies, perf_counter() - begin)
+
+
+def bench_handlers(atlas, count, rate, workers, **sizes):
+    client = StubClient(sizes["users"], sizes["channels"])
+    return {
+        name: drive(call, count, rate, workers)
+        for name, call in handler_calls(atlas, client, **sizes).items()
+    }
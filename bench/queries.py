@@ -0,0 +1,91 @@
+from time import perf_counter
+import json
+
+from db import connect, options
+from bench.seed import base_ts, user_name, emoji_name, channel_name
+from bench.stats import summary
+
+# arguments for the i-th call of each db function, writes are rolled back
+# after every call so each one runs against the same seeded data
+query_args = {
+    "insert_reaction": lambda i: (1, 1, base_ts + i, 0),
+    "insert_message": lambda i: (1, channel_name(0), f"bench {i}", base_ts + i),
+    "insert_emoji_with_name": lambda i: (f"bench_{i}", base_ts + i),
+    "insert_user_with_id": lambda i: (f"bench_{i}",),
+    "get_schema_version": lambda i: (),
+    "get_emoji_with_name": lambda i: (emoji_name(i % 200),),
+    "get_user_with_id": lambda i: (user_name(i % 100),),
+    "get_message": lambda i: (channel_name(i % 20), str(base_ts + i % 1000)),
+    "get_message_text": lambda i: (i % 1000 + 1,),
+    "get_unanalysed_messages": lambda i: (list(range(1, 65)), 1),
+    "get_unanalysed_messages_after": lambda i: (i % 1000, 1, 64),
+    "get_unanalysed_count": lambda i: (1,),
+    "get_emoji_ids_by_names": lambda i: ([emoji_name(j) for j in range(50)],),
+    "get_model_by_name": lambda i: ("vader",),
+    "get_analysis": lambda i: (i % 1000 + 1, 1),
+    "delete_emoji_ids": lambda i: ([i % 200 + 1],),
+    "purge_removed_emojis": lambda i: (500,),
+    "get_purge_backlog": lambda i: (),
+    "top_n_emojis": lambda i: (10, i % 2),
+    "top_n_recent": lambda i: (10,),
+    "top_n_positive_emojis": lambda i: (10, 0),
+    "top_n_negative_emojis": lambda i: (10, 0),
+    "top_n_neutral_emojis": lambda i: (10, 0),
+    "top_n_sentiment_emojis": lambda i: (4, 0, i % 3 - 1),
+    "top_n_emojis_by_sentiment": lambda i: (10, 0),
+    "top_n_emojis_by_user": lambda i: (
+        10,
+        user_name(i % 100),
+        0,
+        channel_name(i % 20) if i % 2 else None,
+    ),
+    "top_n_emojis_since": lambda i: (
+        10,
+        i % 2,
+        base_ts + i % 30 * 86400,
+        channel_name(i % 20) if i % 3 == 0 else None,
+    ),
+    "top_n_emojis_by_user_since": lambda i: (
+        10,
+        user_name(i % 100),
+        0,
+        base_ts + i % 30 * 86400,
+        channel_name(i % 20) if i % 2 else None,
+    ),
+    "rename_emoji_with_name": lambda i: (emoji_name(i % 200), f"bench_{i}"),
+    "update_reaction_with_message": lambda i: (i % 1000 + 1, 1),
+    "insert_model": lambda i: (f"bench_{i}",),
+    "insert_analysis": lambda i: (1, 1, json.dumps({"compound": 0.5})),
+    "insert_analyses": lambda i: [
+        [(j, 1, json.dumps({"compound": 0.5})) for j in range(1, 65)]
+    ],
+    "insert_analyses_with_uses": lambda i: [
+        [(j, 1, json.dumps({"compound": 0.5})) for j in range(1, 65)]
+    ],
+    "rebuild_emoji_usage": lambda i: (),
+    "verify_emoji_usage": lambda i: (),
+    "rebuild_user_emoji_usage": lambda i: (),
+    "prune_message_text": lambda i: (base_ts + 500,),
+    "rebuild_rollups": lambda i: (),
+    "compact_rollups": lambda i: (base_ts + 30 * 86400,),
+}
+
+
+def bench_queries(name, calls):
+    con = connect(name)
+    results = {}
+    for option, query in options.items():
+        if option not in query_args:
+            continue
+        latencies = []
+        begin = perf_counter()
+        for i in range(calls):
+            args = query_args[option](i)
+            start = perf_counter()
+            query(con, *args)
+            latencies.append(perf_counter() - start)
+            con.rollback()
+        results[option] = summary(latencies, perf_counter() - begin)
+    con.close()
+    results["skipped"] = sorted(set(options) - set(query_args))
+    return results
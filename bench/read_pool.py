@@ -0,0 +1,79 @@
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from threading import Thread, Event
+from time import perf_counter
+from os import path
+import json
+
+from db import Database
+from bench.seed import seed
+from bench.stats import percentile
+
+
+def read_latencies(database, samples):
+    # top_n_recent scans every emoji's reactions, the slowest read we serve
+    latencies = []
+    for i in range(samples):
+        start = perf_counter()
+        database.top_n_recent(10)
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def saturate_writes(database, stop, latencies):
+    while not stop.is_set():
+        start = perf_counter()
+        database.insert_reaction(1, 1, 1700000000.0, 0)
+        latencies.append(perf_counter() - start)
+
+
+def run(name, readers, writers, samples):
+    database = Database(name, readers=readers)
+    idle = read_latencies(database, samples)
+    stop = Event()
+    writes = []
+    threads = [
+        Thread(target=saturate_writes, args=(database, stop, writes))
+        for _ in range(writers)
+    ]
+    for thread in threads:
+        thread.start()
+    loaded = read_latencies(database, samples)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    database.close()
+    return {
+        "readers": readers,
+        "writers": writers,
+        "idle_p50": percentile(idle, 0.5),
+        "idle_p99": percentile(idle, 0.99),
+        "loaded_p50": percentile(loaded, 0.5),
+        "loaded_p99": percentile(loaded, 0.99),
+        "write_p50": percentile(writes, 0.5),
+        "write_p99": percentile(writes, 0.99),
+    }
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Read latency of the db with and without reader processes "
+        "while writes are saturated"
+    )
+    parser.add_argument("--reactions", type=int, default=200000)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--samples", type=int, default=100)
+    args = parser.parse_args(argv)
+    with TemporaryDirectory() as tmp:
+        name = path.join(tmp, "bench.db")
+        seed(name, reactions=args.reactions)
+        results = [
+            run(name, readers, args.writers, args.samples)
+            for readers in (0, args.readers)
+        ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+from random import Random
+import json
+
+from db import (
+    connect,
+    start_db,
+    insert_model,
+    insert_analyses,
+    rebuild_emoji_usage,
+    rebuild_user_emoji_usage,
+    rebuild_rollups,
+)
+
+base_ts = 1600000000.0
+
+
+def user_name(i):
+    return f"U{i:08d}"
+
+
+def emoji_name(i):
+    return f"emoji_{i}"
+
+
+def channel_name(i):
+    return f"C{i:08d}"
+
+
+def message(i, users, channels):
+    # seeded messages are deterministic so a stub slack client can serve them
+    return {
+        "user": user_name(i % users),
+        "channel": channel_name(i % channels),
+        "text": f"message {i} is {('great', 'fine', 'awful')[i % 3]}",
+        "ts": str(base_ts + i),
+    }
+
+
+def seed(
+    name,
+    users=100,
+    emojis=200,
+    channels=20,
+    messages=10000,
+    reactions=100000,
+    seed=0,
+):
+    rand = Random(seed)
+    con = connect(name)
+    start_db(con)
+    con.executemany(
+        "INSERT INTO slack_user (slack_user_id) VALUES (?)",
+        ((user_name(i),) for i in range(users)),
+    )
+    con.executemany(
+        "INSERT INTO emoji (name, first_used_created) VALUES (?, ?)",
+        ((emoji_name(i), base_ts + i) for i in range(emojis)),
+    )
+    con.executemany(
+        "INSERT INTO message (id, user_id, channel, timestamp) VALUES (?, ?, ?, ?)",
+        (
+            (i + 1, i % users + 1, m["channel"], m["ts"])
+            for i, m in ((i, message(i, users, channels)) for i in range(messages))
+        ),
+    )
+    con.executemany(
+        "INSERT INTO message_text (message_id, m_text) VALUES (?, ?)",
+        ((i + 1, message(i, users, channels)["text"]) for i in range(messages)),
+    )
+    con.executemany(
+        "INSERT INTO reaction (user_id, message_id, emoji_id, timestamp, remove) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                rand.randint(1, users),
+                rand.randint(1, messages),
+                # a few popular emojis and a long tail, like a real workspace
+                min(int(rand.paretovariate(1)), emojis),
+                # one a minute so the rollups see a realistic spread of buckets
+                base_ts + i * 60,
+                int(rand.random() < 0.1),
+            )
+            for i in range(reactions)
+        ),
+    )
+    model_id = insert_model(con, "vader")
+    insert_analyses(
+        con,
+        (
+            (i + 1, model_id, json.dumps({"compound": rand.uniform(-1, 1)}))
+            for i in range(messages)
+        ),
+    )
+    rebuild_emoji_usage(con)
+    rebuild_user_emoji_usage(con)
+    rebuild_rollups(con)
+    con.commit()
+    con.close()
@@ -0,0 +1,12 @@
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def summary(latencies, elapsed):
+    return {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+    }
@@ -0,0 +1,131 @@
+from multiprocessing import Pool
+from queue import Queue, Empty
+from threading import Thread
+from os import environ, path, stat
+import logging
+import pickle
+import json
+
+from metrics import span
+
+lexicon_cache = environ.get(
+    "vader_lexicon_cache", path.join(path.dirname(__file__), "vader_lexicon.pickle")
+)
+
+# one analyzer per process, built once so the lexicon is only loaded once
+_analyzer = None
+
+
+def load_analyzer():
+    # vader parses its text lexicons on every start, keep the parsed dicts in a
+    # pickle that is rebuilt whenever the lexicon files change
+    from vaderSentiment import vaderSentiment
+
+    directory = path.dirname(vaderSentiment.__file__)
+    key = [
+        (stat(lexicon).st_mtime_ns, stat(lexicon).st_size)
+        for lexicon in (
+            path.join(directory, "vader_lexicon.txt"),
+            path.join(directory, "emoji_utf8_lexicon.txt"),
+        )
+        if path.exists(lexicon)
+    ]
+    try:
+        with open(lexicon_cache, "rb") as f:
+            cached_key, lexicon, emojis = pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        cached_key = None
+    if cached_key != key:
+        analyzer = vaderSentiment.SentimentIntensityAnalyzer()
+        try:
+            with open(lexicon_cache, "wb") as f:
+                pickle.dump((key, analyzer.lexicon, analyzer.emojis), f, protocol=4)
+        except OSError as e:
+            logging.warning(f"Couldn't write vader lexicon cache: {e}")
+        return analyzer
+    analyzer = vaderSentiment.SentimentIntensityAnalyzer.__new__(
+        vaderSentiment.SentimentIntensityAnalyzer
+    )
+    analyzer.lexicon, analyzer.emojis = lexicon, emojis
+    return analyzer
+
+
+def _init_analyzer():
+    # forked pool processes inherit the analyzer loaded by the parent
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = load_analyzer()
+
+
+def polarity_scores(text):
+    return _analyzer.polarity_scores(text)
+
+
+# scoring function per model name, called in a pool started with _init_analyzer
+scorers = {"vader": polarity_scores}
+
+
+class Analyzer:
+    def __init__(
+        self, database, model_name="vader", processes=1, batch_size=64, on_uses=None
+    ):
+        self.database = database
+        self.model_name = model_name
+        # called with the db and the sentiment uses each batch of analyses adds
+        self.on_uses = on_uses
+        # per team, each shard of a ShardedDatabase registers the model itself
+        self.model_ids = {}
+        self.batch_size = batch_size
+        _init_analyzer()
+        self.pool = Pool(processes, initializer=_init_analyzer)
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def score(self, text):
+        # a single text is scored with the parent's analyzer, in the pool it would
+        # wait behind the background batches
+        with span("vader_score"):
+            return polarity_scores(text)
+
+    def submit(self, message_id, team=None):
+        self.queue.put((team, message_id))
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            by_team = {}
+            for team, message_id in self._next_batch():
+                by_team.setdefault(team, set()).add(message_id)
+            for team, message_ids in by_team.items():
+                try:
+                    self._analyse(team, message_ids)
+                except Exception as e:
+                    logging.error(f"Couldn't analyse messages {message_ids}: {e}")
+
+    def _analyse(self, team, message_ids):
+        database = self.database.shard(team)
+        if team not in self.model_ids:
+            self.model_ids[team] = database.get_model_by_name(
+                self.model_name
+            ) or database.insert_model(self.model_name)
+        model_id = self.model_ids[team]
+        messages = database.get_unanalysed_messages(list(message_ids), model_id)
+        if not messages:
+            return
+        ids, texts = zip(*messages)
+        with span("vader_batch"):
+            scores = self.pool.map(polarity_scores, texts)
+        uses = database.insert_analyses_with_uses(
+            [(i, model_id, json.dumps(s)) for i, s in zip(ids, scores)]
+        )
+        if self.on_uses:
+            self.on_uses(database, uses)
@@ -0,0 +1,224 @@
+from functools import partial
+from itertools import chain
+from os import environ
+from time import time
+import asyncio
+import signal
+
+from aiohttp import ClientSession
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.web.async_client import AsyncWebClient
+
+# the db worker, analyzer pool and caches are shared with the threaded app
+import emoji_atlas as atlas
+from metrics import span, startup_phase, serve
+from db import AsyncDatabase, emoji_user_ts_from_event, sentiment_bucket, sentiments
+from views import emote_view, top_emojis_view
+
+database = AsyncDatabase(atlas.database)
+
+
+async def load_user_id(team, user):
+    db = await database.shard(team)
+    return await db.get_user_with_id(user) or await db.insert_user_with_id(user)
+
+
+async def load_emoji_id(team, emoji, ts):
+    db = await database.shard(team)
+    return await db.get_emoji_with_name(emoji) or await db.insert_emoji_with_name(
+        emoji, ts
+    )
+
+
+async def get_user_id(team, user):
+    return await atlas.user_ids.get_or_load_async(
+        (team, user), partial(load_user_id, team, user)
+    )
+
+
+async def get_emoji_id(team, emoji, ts):
+    return await atlas.emoji_ids.get_or_load_async(
+        (team, emoji), partial(load_emoji_id, team, emoji, ts)
+    )
+
+
+async def fetch_message_id(team, client, channel, message_ts):
+    db = await database.shard(team)
+    message_id = await db.get_message(channel, message_ts)
+    if message_id:
+        return message_id
+    with span("conversations_history"):
+        result = await client.conversations_history(
+            channel=channel, inclusive=True, oldest=message_ts, limit=1
+        )
+    message = result["messages"][0]
+    text, user, ts = message["text"], message["user"], message["ts"]
+    message_id = await db.insert_message(
+        await get_user_id(team, user), channel, text, ts
+    )
+    atlas.analyzer.submit(message_id, team)
+    return message_id
+
+
+async def add_message_to_reaction(team, client, logger, reaction_id, reaction_item):
+    # only care about messages
+    if reaction_item["type"] != "message":
+        logger.info("Reaction to none message")
+        return
+    channel, message_ts = reaction_item["channel"], reaction_item["ts"]
+    try:
+        message_id = await atlas.message_ids.get_or_load_async(
+            (team, channel, message_ts),
+            partial(fetch_message_id, team, client, channel, message_ts),
+        )
+    except Exception as e:
+        logger.info(f"Couldn't retrieve message for reaction {e}")
+        return
+    db = await database.shard(team)
+    uses = await db.update_reaction_with_message(reaction_id, message_id)
+    atlas.leaderboards.add(db.database, uses)
+
+
+async def reaction_event(remove_flag, logger, ack, body, client, context):
+    await ack()
+    team = atlas.team_of(context)
+    if atlas.ingest.dedupe.seen(atlas.reaction_keys(team, remove_flag, body)):
+        logger.info("Dropping duplicate reaction event")
+        return
+    with span("reaction_event"):
+        emoji, user, ts = emoji_user_ts_from_event(body)
+        logger.info(f"reaction: {emoji} by: {user}!")
+
+        user_id = await get_user_id(team, user)
+        emoji_id = await get_emoji_id(team, emoji, ts)
+        db = await database.shard(team)
+        reaction_id = await db.insert_reaction(user_id, emoji_id, ts, remove_flag)
+        await add_message_to_reaction(
+            team, client, logger, reaction_id, body["event"]["item"]
+        )
+
+
+async def reaction_added(logger, ack, body, client, context):
+    await reaction_event(0, logger, ack, body, client, context)
+
+
+async def reaction_removed(logger, ack, body, client, context):
+    await reaction_event(1, logger, ack, body, client, context)
+
+
+async def emoji_remove(team, names):
+    db = await database.shard(team)
+    ids = await db.get_emoji_ids_by_names(names)
+    await db.delete_emoji_ids(list(chain(*ids)))
+    atlas.emoji_ids.invalidate(*((team, name) for name in names))
+    atlas.leaderboards.remove(db.database, names)
+
+
+async def emoji_changed(logger, ack, event, context):
+    with span("emoji_changed"):
+        team = atlas.team_of(context)
+        db = await database.shard(team)
+        sub_type = event["subtype"]
+        if sub_type == "remove":
+            await emoji_remove(team, event["names"])
+        elif sub_type == "rename":
+            await db.rename_emoji_with_name(event["old_name"], event["new_name"])
+            atlas.emoji_ids.invalidate(
+                (team, event["old_name"]), (team, event["new_name"])
+            )
+            atlas.leaderboards.rename(db.database, event["old_name"], event["new_name"])
+        elif sub_type == "add":
+            atlas.emoji_ids.put(
+                (team, event["name"]),
+                await db.insert_emoji_with_name(event["name"], event["event_ts"]),
+            )
+        else:
+            raise NotImplementedError(f"Unhandled subtype {event}")
+
+
+async def emote(client, logger, ack, shortcut, context):
+    with span("emote"):
+        await ack()
+        logger.info("Recieved emote request")
+        react_to = shortcut["message"]["text"]
+        # scored off the loop in a thread, score records the vader_score span
+        sentiment = await asyncio.get_running_loop().run_in_executor(
+            None, atlas.analyzer.score, react_to
+        )
+        bucket = sentiment_bucket(sentiment["compound"])
+        db = (await database.shard(atlas.team_of(context))).database
+        board = atlas.leaderboards.loaded(db)
+        if board is None:
+            # a team's first emote loads its leaderboard, off the loop in a thread
+            board = await asyncio.get_running_loop().run_in_executor(
+                None, atlas.leaderboards.get, db
+            )
+        emojis = board.top(4, bucket)
+        with span("views_open"):
+            await client.views_open(
+                trigger_id=shortcut["trigger_id"],
+                view=emote_view(sentiments[bucket], emojis),
+            )
+
+
+async def show_user_top_emoji(ack, logger, command, client, context):
+    with span("show_user_top_emoji"):
+        await ack()
+        user, channel, days = atlas.parse_top_emojis_command(command["text"])
+        db = await database.shard(atlas.team_of(context))
+        if not user:
+            emojis = []
+        elif days:
+            since = time() - days * 86400
+            emojis = await db.top_n_emojis_by_user_since(10, user, 0, since, channel)
+        else:
+            emojis = await db.top_n_emojis_by_user(10, user, 0, channel)
+        with span("views_open"):
+            await client.views_open(
+                trigger_id=command["trigger_id"],
+                view=top_emojis_view(user, channel, emojis, days),
+            )
+
+
+async def home_tab(client, event, logger, context):
+    with span("home_tab"):
+        logger.info("Home page visited")
+        # only the very first open builds the view, off the loop in a thread
+        view = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: atlas.home_views_for(atlas.team_of(context)).get()
+        )
+        try:
+            with span("views_publish"):
+                await client.views_publish(user_id=event["user"], view=view)
+        except Exception as e:
+            logger.error(f"Error publishing home tab: {e}")
+
+
+def create_app(client):
+    app = AsyncApp(client=client)
+    app.event("reaction_added")(reaction_added)
+    app.event("reaction_removed")(reaction_removed)
+    app.event("emoji_changed")(emoji_changed)
+    app.shortcut("emote")(emote)
+    app.command("/top-emojis")(show_user_top_emoji)
+    app.event("app_home_opened")(home_tab)
+    return app
+
+
+async def main():
+    # one aiohttp session so every web api call reuses pooled connections
+    async with ClientSession() as session:
+        client = AsyncWebClient(token=environ["bot_token"], session=session)
+        with startup_phase("app"):
+            handler = AsyncSocketModeHandler(create_app(client), environ["app_token"])
+        with startup_phase("connect"):
+            await handler.connect_async()
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, atlas.signal_handler)
+    if "metrics_port" in environ:
+        serve(int(environ["metrics_port"]))
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Thread, Lock
+from functools import partial
+from time import monotonic
+import logging
+
+_missing = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.tasks = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        value, expires = self.entries.get(key, (_missing, None))
+        if expires is not None and expires < monotonic():
+            del self.entries[key]
+            return _missing
+        if value is not _missing:
+            self.entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._lookup(key)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def get_or_load(self, key, load):
+        # concurrent misses for the same key share a single call to load
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+        with self.lock:
+            value = self._lookup(key)
+            if value is not _missing:
+                return value
+            future = self.loading.get(key)
+            leader = future is None
+            if leader:
+                future = self.loading[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            value = load()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    async def get_or_load_async(self, key, load):
+        # event loop version of get_or_load, load is a coroutine function
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+        task = self.tasks.get(key)
+        if task is None:
+            # only the async app pays for importing asyncio
+            from asyncio import ensure_future
+
+            task = self.tasks[key] = ensure_future(load())
+            task.add_done_callback(partial(self._loaded, key))
+        return await task
+
+    def _loaded(self, key, task):
+        del self.tasks[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def items(self):
+        with self.lock:
+            return [(key, value) for key, (value, expires) in self.entries.items()]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class VersionedCache:
+    # stale-while-revalidate: serve the last built value and rebuild it in the
+    # background when the data version moved on, at most once per interval
+    def __init__(self, build, version, interval=30):
+        self.build = build
+        self.version = version
+        self.interval = interval
+        self.value = _missing
+        self.built_version = None
+        self.built_at = 0
+        self.lock = Lock()
+
+    def _refresh(self):
+        version = self.version()
+        self.value = self.build()
+        self.built_version, self.built_at = version, monotonic()
+
+    def _background_refresh(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            logging.error(f"Couldn't refresh cached value: {e}")
+        finally:
+            self.lock.release()
+
+    def get(self):
+        if self.value is _missing:
+            with self.lock:
+                if self.value is _missing:
+                    self._refresh()
+        elif (
+            self.built_version != self.version()
+            and monotonic() - self.built_at >= self.interval
+            and self.lock.acquire(blocking=False)
+        ):
+            Thread(target=self._background_refresh, daemon=True).start()
+        return self.value
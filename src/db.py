@@ -1,12 +1,58 @@
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Pipe
+from concurrent.futures import Future
+from collections import deque
+from threading import Thread, Lock
 from functools import partial
-from time import sleep
+from itertools import count, islice
+from time import monotonic, sleep, time
 import sqlite3
 import logging
 import signal
+import json
+import zlib
 
+from metrics import registry
 
-def start_db(con):
+sentiments = {1: "positive", 0: "neutral", -1: "negative"}
+
+
+def sentiment_bucket(compound):
+    if compound is None:
+        return None
+    if compound >= 0.05:
+        return 1
+    if compound <= -0.05:
+        return -1
+    return 0
+
+
+def pack_text(text):
+    # message text is stored as zlib compressed BLOB when that is smaller
+    if text is None or len(text) < 128:
+        return text
+    packed = zlib.compress(text.encode(), 9)
+    return packed if len(packed) < len(text.encode()) else text
+
+
+def unpack_text(stored):
+    return zlib.decompress(stored).decode() if isinstance(stored, bytes) else stored
+
+
+def connect(name, readonly=False):
+    if readonly:
+        con = sqlite3.connect(f"file:{name}?mode=ro", uri=True)
+        con.execute("PRAGMA query_only = ON")
+    else:
+        con = sqlite3.connect(name)
+        # only takes effect on a new db, before journal_mode writes its header
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA busy_timeout = 5000")
+    return con
+
+
+def create_tables(con):
     create_slack_user = (
         "CREATE TABLE IF NOT EXISTS slack_user( "
         "id INTEGER PRIMARY KEY, "
@@ -60,6 +106,217 @@ def start_db(con):
     con.execute(create_analysis)
 
 
+def create_indexes(con):
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_emoji ON reaction(emoji_id, remove);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_message "
+        "ON reaction(message_id, remove, emoji_id);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_user "
+        "ON reaction(user_id, remove, emoji_id, message_id);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS message_user_text_ts "
+        "ON message(user_id, m_text, timestamp);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS analysis_message_model "
+        "ON analysis(message_id, model_id);"
+    )
+
+
+def create_emoji_usage(con):
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS emoji_usage( "
+        "emoji_id INTEGER NOT NULL, "
+        "remove INTEGER NOT NULL, "
+        "uses INTEGER NOT NULL, "
+        "PRIMARY KEY (emoji_id, remove), "
+        "FOREIGN KEY (emoji_id) REFERENCES emoji (id));"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS emoji_usage_top ON emoji_usage(remove, uses);"
+    )
+    # migrations keep the sql they shipped with, the live rebuild helpers change
+    con.execute(
+        "INSERT INTO emoji_usage (emoji_id, remove, uses) "
+        "SELECT emoji_id, remove, count(*) FROM reaction "
+        "WHERE emoji_id IS NOT NULL "
+        "GROUP BY emoji_id, remove"
+    )
+
+
+def add_analysis_sentiment(con):
+    con.execute("ALTER TABLE analysis ADD COLUMN compound REAL;")
+    con.execute("ALTER TABLE analysis ADD COLUMN sentiment INTEGER;")
+    con.create_function("sentiment_bucket", 1, sentiment_bucket)
+    con.execute("UPDATE analysis SET compound = json_extract(result, '$.compound');")
+    con.execute("UPDATE analysis SET sentiment = sentiment_bucket(compound);")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS analysis_sentiment "
+        "ON analysis(sentiment, message_id);"
+    )
+
+
+def create_reaction_rollup(con):
+    # per hour (span 3600) or, once compacted, per day (span 86400) reaction
+    # counts. channel '' rows count every reaction, the channel of a reaction
+    # is only known once its message has been fetched
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS reaction_rollup( "
+        "bucket INTEGER NOT NULL, "
+        "span INTEGER NOT NULL, "
+        "emoji_id INTEGER NOT NULL, "
+        "channel TEXT NOT NULL, "
+        "user_id INTEGER NOT NULL, "
+        "remove INTEGER NOT NULL, "
+        "uses INTEGER NOT NULL, "
+        "PRIMARY KEY (bucket, span, emoji_id, channel, user_id, remove), "
+        "FOREIGN KEY (emoji_id) REFERENCES emoji (id), "
+        "FOREIGN KEY (user_id) REFERENCES slack_user(id));"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_rollup_channel "
+        "ON reaction_rollup(channel, remove, bucket);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_rollup_user "
+        "ON reaction_rollup(user_id, channel, remove, bucket);"
+    )
+    for channel_column, join in [
+        ("''", ""),
+        ("message.channel", "INNER JOIN message ON message.id = reaction.message_id "),
+    ]:
+        con.execute(
+            "INSERT INTO reaction_rollup "
+            "(bucket, span, emoji_id, channel, user_id, remove, uses) "
+            "SELECT CAST(reaction.timestamp AS INTEGER) "
+            "- CAST(reaction.timestamp AS INTEGER) % 3600, 3600, "
+            f"reaction.emoji_id, {channel_column}, reaction.user_id, "
+            "reaction.remove, count(*) "
+            f"FROM reaction {join}"
+            "WHERE reaction.emoji_id IS NOT NULL AND reaction.user_id IS NOT NULL "
+            "GROUP BY 1, 3, 4, 5, 6"
+        )
+
+
+def create_user_emoji_usage(con):
+    # per user reaction counts for /top-emojis, channel '' counts every channel
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS user_emoji_usage( "
+        "user_id INTEGER NOT NULL, "
+        "channel TEXT NOT NULL, "
+        "emoji_id INTEGER NOT NULL, "
+        "remove INTEGER NOT NULL, "
+        "uses INTEGER NOT NULL, "
+        "PRIMARY KEY (user_id, channel, remove, emoji_id), "
+        "FOREIGN KEY (emoji_id) REFERENCES emoji (id), "
+        "FOREIGN KEY (user_id) REFERENCES slack_user(id));"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS user_emoji_usage_top "
+        "ON user_emoji_usage(user_id, channel, remove, uses);"
+    )
+    for channel_column, join in [
+        ("''", ""),
+        ("message.channel", "INNER JOIN message ON message.id = reaction.message_id "),
+    ]:
+        con.execute(
+            "INSERT INTO user_emoji_usage (user_id, channel, remove, emoji_id, uses) "
+            f"SELECT reaction.user_id, {channel_column}, reaction.remove, "
+            f"reaction.emoji_id, count(*) FROM reaction {join}"
+            "WHERE reaction.emoji_id IS NOT NULL AND reaction.user_id IS NOT NULL "
+            "GROUP BY 1, 2, 3, 4"
+        )
+
+
+def compact_messages(con):
+    # messages are identified by (channel, ts) instead of by their text, merge
+    # the copies of a message that was edited between reactions
+    duplicates = (
+        "SELECT id FROM message WHERE EXISTS (SELECT 1 FROM message AS first "
+        "WHERE first.channel = message.channel "
+        "AND first.timestamp = message.timestamp AND first.id < message.id)"
+    )
+    con.execute(
+        "UPDATE reaction SET message_id = (SELECT min(first.id) FROM message "
+        "INNER JOIN message AS first ON first.channel = message.channel "
+        "AND first.timestamp = message.timestamp "
+        "WHERE message.id = reaction.message_id) "
+        f"WHERE message_id IN ({duplicates})"
+    )
+    con.execute(f"DELETE FROM analysis WHERE message_id IN ({duplicates})")
+    con.execute(f"DELETE FROM message WHERE id IN ({duplicates})")
+    con.execute("DROP INDEX IF EXISTS message_user_text_ts")
+    con.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS message_channel_ts "
+        "ON message(channel, timestamp);"
+    )
+    # text lives in its own table so pruning it frees whole pages
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS message_text( "
+        "message_id INTEGER PRIMARY KEY, "
+        "m_text, "
+        "FOREIGN KEY (message_id) REFERENCES message(id));"
+    )
+    con.create_function("pack_text", 1, pack_text)
+    moved = con.execute(
+        "INSERT INTO message_text (message_id, m_text) "
+        "SELECT id, pack_text(m_text) FROM message WHERE m_text IS NOT NULL;"
+    ).rowcount
+    if moved:
+        con.execute("UPDATE message SET m_text = NULL;")
+        logging.info("run maintenance.py vacuum to reclaim the space of message.m_text")
+
+
+def add_emoji_tombstone(con):
+    con.execute("ALTER TABLE emoji ADD COLUMN removed REAL;")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS reaction_rollup_emoji "
+        "ON reaction_rollup(emoji_id);"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS user_emoji_usage_emoji "
+        "ON user_emoji_usage(emoji_id);"
+    )
+
+
+# migrations[i] upgrades a db from user_version i to i + 1, only ever append
+migrations = [
+    create_tables,
+    create_indexes,
+    create_emoji_usage,
+    add_analysis_sentiment,
+    create_reaction_rollup,
+    create_user_emoji_usage,
+    compact_messages,
+    add_emoji_tombstone,
+]
+
+
+def start_db(con):
+    version = get_schema_version(con)
+    for version, migration in enumerate(migrations[version:], version + 1):
+        logging.info(f"migrating db to version {version}")
+        # BEGIN keeps the schema changes in the migration's transaction, without
+        # it each one commits on its own
+        con.execute("BEGIN")
+        try:
+            migration(con)
+            con.execute(f"PRAGMA user_version = {version}")
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+
+def get_schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
 def get_user_with_id(con, user_id):
     res = con.execute(
         "SELECT id FROM slack_user WHERE slack_user_id = ?", (user_id,)
@@ -72,17 +329,24 @@ def get_emoji_with_name(con, emoji):
     return res[0][0] if res else False
 
 
-def get_message(con, user_id, text, ts):
+def get_message(con, channel, ts):
     res = con.execute(
-        "SELECT id FROM message WHERE user_id = ? AND m_text = ? AND timestamp = ?",
-        (user_id, text, ts),
+        "SELECT id FROM message WHERE channel = ? AND timestamp = ?",
+        (channel, ts),
     ).fetchall()
     return res[0][0] if res else False
 
 
 def get_message_text(con, message_id):
     res = con.execute(
-        "SELECT m_text FROM message WHERE id = ?", (message_id,)
+        "SELECT m_text FROM message_text WHERE message_id = ?", (message_id,)
+    ).fetchall()
+    return unpack_text(res[0][0]) if res else False
+
+
+def get_message_channel(con, message_id):
+    res = con.execute(
+        "SELECT channel FROM message WHERE id = ?", (message_id,)
     ).fetchall()
     return res[0][0] if res else False
 
@@ -100,19 +364,107 @@ def get_analysis(con, message_id, model_id):
     return res[0][0] if res else False
 
 
+def get_unanalysed_messages(con, message_ids, model_id):
+    qs = ", ".join("?" for _ in message_ids)
+    return [
+        (message_id, unpack_text(text))
+        for message_id, text in con.execute(
+            f"SELECT message_id, m_text FROM message_text WHERE message_id IN ({qs}) "
+            "AND NOT EXISTS (SELECT 1 FROM analysis WHERE "
+            "analysis.message_id = message_text.message_id AND analysis.model_id = ?)",
+            list(message_ids) + [model_id],
+        )
+    ]
+
+
+def get_unanalysed_messages_after(con, after, model_id, n):
+    # keyset pages over every message the model hasn't analysed yet
+    return [
+        (message_id, unpack_text(text))
+        for message_id, text in con.execute(
+            "SELECT message_id, m_text FROM message_text WHERE message_id > ? "
+            "AND NOT EXISTS (SELECT 1 FROM analysis WHERE "
+            "analysis.message_id = message_text.message_id AND analysis.model_id = ?) "
+            "ORDER BY message_id LIMIT ?",
+            (after, model_id, n),
+        )
+    ]
+
+
+def get_unanalysed_count(con, model_id):
+    return con.execute(
+        "SELECT count(*) FROM message_text WHERE NOT EXISTS (SELECT 1 FROM analysis "
+        "WHERE analysis.message_id = message_text.message_id "
+        "AND analysis.model_id = ?)",
+        (model_id,),
+    ).fetchone()[0]
+
+
+def scan_emoji_ids_by_names(con, emojis):
+    # a query per 500 names, sqlite caps the number of parameters
+    for i in range(0, len(emojis), 500):
+        names = emojis[i : i + 500]
+        qs = ", ".join("?" for _ in names)
+        yield from con.execute(f"SELECT id from emoji WHERE name in ({qs})", names)
+
+
 def get_emoji_ids_by_names(con, emojis):
-    qs = ", ".join("?" for _ in emojis)
-    return con.execute(f"SELECT id from emoji WHERE name in ({qs})", emojis).fetchall()
+    return list(scan_emoji_ids_by_names(con, emojis))
+
+
+def scan_reactions(con, since=0):
+    # every reaction since with its slack ids, the rows of an export
+    return con.execute(
+        "SELECT reaction.id, slack_user.slack_user_id, emoji.name, message.channel, "
+        "message.timestamp, reaction.timestamp, reaction.remove FROM reaction "
+        "INNER JOIN slack_user ON slack_user.id = reaction.user_id "
+        "INNER JOIN emoji ON emoji.id = reaction.emoji_id "
+        "LEFT JOIN message ON message.id = reaction.message_id "
+        "WHERE reaction.timestamp >= ? AND emoji.removed IS NULL "
+        "ORDER BY reaction.id",
+        (since,),
+    )
 
 
 def delete_emoji_ids(con, ids):
+    # tombstones the emoji and frees its name, reads skip it from now on and the
+    # writer purges its rows a batch at a time in between other calls
     qs = ", ".join("?" for _ in ids)
-    first = con.execute(
-        f"DELETE FROM reaction WHERE emoji_id IN ({qs})", ids
+    res = con.execute(
+        f"UPDATE emoji SET name = NULL, removed = ? WHERE id IN ({qs})",
+        [time()] + list(ids),
+    ).fetchall()
+    con.execute(f"DELETE FROM emoji_usage WHERE emoji_id IN ({qs})", ids)
+    return res
+
+
+removed_emoji_ids = "(SELECT id FROM emoji WHERE removed IS NOT NULL)"
+
+
+def purge_removed_emojis(con, n):
+    # deletes up to n rows of removed emoji, the emoji itself goes with the last
+    purged = 0
+    for table in ["reaction", "reaction_rollup", "user_emoji_usage", "emoji_usage"]:
+        purged += con.execute(
+            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} "
+            f"WHERE emoji_id IN {removed_emoji_ids} LIMIT ?)",
+            (n - purged,),
+        ).rowcount
+        if purged == n:
+            return purged
+    done = con.execute("DELETE FROM emoji WHERE removed IS NOT NULL").rowcount
+    if done:
+        logging.info(f"purged {done} removed emoji")
+    return purged
+
+
+def get_purge_backlog(con):
+    # rows of (emoji_id, removed, reactions left to purge)
+    return con.execute(
+        "SELECT emoji.id, emoji.removed, count(reaction.id) FROM emoji "
+        "LEFT JOIN reaction ON reaction.emoji_id = emoji.id "
+        "WHERE emoji.removed IS NOT NULL GROUP BY emoji.id"
     ).fetchall()
-    second = con.execute(f"DELETE FROM emoji WHERE id in ({qs})", ids).fetchall()
-    con.commit()
-    return first + second
 
 
 def insert_user_with_id(con, user_id):
@@ -122,7 +474,6 @@ def insert_user_with_id(con, user_id):
     ).fetchall()
     res = cur.lastrowid
     cur.close()
-    con.commit()
     return res
 
 
@@ -133,48 +484,137 @@ def insert_emoji_with_name(con, emoji_name, ts):
     ).fetchall()
     res = cur.lastrowid
     cur.close()
-    con.commit()
     return res
 
 
 def insert_message(con, user_id, channel, text, ts):
     cur = con.cursor()
     cur.execute(
-        "INSERT INTO message (user_id, channel, m_text, timestamp) VALUES (?, ?, ?, ?);",
-        (user_id, channel, text, ts),
+        "INSERT OR IGNORE INTO message (user_id, channel, timestamp) VALUES (?, ?, ?);",
+        (user_id, channel, ts),
     ).fetchall()
+    if not cur.rowcount:
+        cur.close()
+        return get_message(con, channel, ts)
     res = cur.lastrowid
+    cur.execute(
+        "INSERT INTO message_text (message_id, m_text) VALUES (?, ?)",
+        (res, pack_text(text)),
+    )
     cur.close()
-    con.commit()
     return res
 
 
+def prune_message_text(con, before):
+    # text is only needed to analyse a message, drop it from old messages every
+    # registered model has already analysed. Models are registered lazily, so a
+    # message no model has analysed yet keeps its text
+    return con.execute(
+        "DELETE FROM message_text WHERE message_id IN ("
+        "SELECT id FROM message WHERE timestamp < ? "
+        "AND EXISTS (SELECT 1 FROM analysis WHERE analysis.message_id = message.id) "
+        "AND NOT EXISTS (SELECT 1 FROM model WHERE NOT EXISTS ("
+        "SELECT 1 FROM analysis "
+        "WHERE analysis.message_id = message.id AND analysis.model_id = model.id)))",
+        (before,),
+    ).rowcount
+
+
+def incremental_vacuum(con):
+    # hands free pages back to the os, needs auto_vacuum = INCREMENTAL
+    freed = con.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript steps the pragma to completion, execute frees a single page
+    con.executescript("PRAGMA incremental_vacuum;")
+    return freed - con.execute("PRAGMA freelist_count").fetchone()[0]
+
+
 def insert_model(con, model_name):
     cur = con.cursor()
     cur.execute("INSERT INTO model (name) VALUES (?)", (model_name,)).fetchall()
     res = cur.lastrowid
     cur.close()
-    con.commit()
     return res
 
 
+def _analysis_row(message_id, model_id, result):
+    compound = json.loads(result).get("compound")
+    return (message_id, model_id, result, compound, sentiment_bucket(compound))
+
+
+insert_analysis_query = (
+    "INSERT INTO analysis (message_id, model_id, result, compound, sentiment) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+
 def insert_analysis(con, message_id, model_id, result):
     cur = con.cursor()
     cur.execute(
-        "INSERT INTO analysis (message_id, model_id, result) VALUES (?, ?, ?)",
-        (message_id, model_id, result),
+        insert_analysis_query, _analysis_row(message_id, model_id, result)
     ).fetchall()
     res = cur.lastrowid
     cur.close()
-    con.commit()
     return res
 
 
+def insert_analyses(con, analyses):
+    return con.executemany(
+        insert_analysis_query, (_analysis_row(*analysis) for analysis in analyses)
+    ).rowcount
+
+
+def _sentiment_uses(con, where="", args=()):
+    # (sentiment, emoji name, uses) as top_n_sentiment_emojis counts them
+    return con.execute(
+        "SELECT analysis.sentiment, emoji.name, count(*) FROM analysis "
+        "INNER JOIN reaction ON reaction.message_id = analysis.message_id "
+        "INNER JOIN emoji ON reaction.emoji_id = emoji.id "
+        "WHERE reaction.remove = 0 AND analysis.sentiment IS NOT NULL "
+        f"AND emoji.removed IS NULL {where}"
+        "GROUP BY analysis.sentiment, emoji.name",
+        args,
+    )
+
+
+def scan_sentiment_uses(con):
+    return _sentiment_uses(con)
+
+
+def get_sentiment_uses_of(con, names):
+    uses = []
+    for i in range(0, len(names), 500):
+        chunk = names[i : i + 500]
+        qs = ", ".join("?" for _ in chunk)
+        uses.extend(_sentiment_uses(con, f"AND emoji.name IN ({qs}) ", chunk))
+    return uses
+
+
+def insert_analyses_with_uses(con, analyses):
+    # returns the uses the new analyses add, for the app's leaderboards
+    analyses = list(analyses)
+    last_id = con.execute("SELECT coalesce(max(id), 0) FROM analysis").fetchone()[0]
+    insert_analyses(con, analyses)
+    # looked up by message so the plan starts from the new messages' reactions,
+    # analysis.id alone would scan every reaction
+    message_ids = sorted({analysis[0] for analysis in analyses})
+    uses = []
+    for i in range(0, len(message_ids), 500):
+        ids = message_ids[i : i + 500]
+        qs = ", ".join("?" for _ in ids)
+        uses.extend(
+            _sentiment_uses(
+                con,
+                f"AND analysis.message_id IN ({qs}) AND analysis.id > ? ",
+                ids + [last_id],
+            )
+        )
+    return uses
+
+
 def rename_emoji_with_name(con, emoji_name, new_name):
     res = con.execute(
         "UPDATE emoji SET name = ? WHERE name = ?", (new_name, emoji_name)
     ).fetchall()
-    con.commit()
     return res
 
 
@@ -186,35 +626,203 @@ def insert_reaction(con, user_id, emoji_id, ts, remove):
     ).fetchall()
     res = cur.lastrowid
     cur.close()
-    con.commit()
+    count_emoji_use(con, emoji_id, remove)
+    add_rollups(con, [(hour(ts), hour_span, emoji_id, "", user_id, remove, 1)])
+    count_user_emoji_use(con, user_id, "", emoji_id, remove)
     return res
 
 
+def count_emoji_use(con, emoji_id, remove):
+    con.execute(
+        "INSERT OR IGNORE INTO emoji_usage (emoji_id, remove, uses) VALUES (?, ?, 0)",
+        (emoji_id, remove),
+    )
+    con.execute(
+        "UPDATE emoji_usage SET uses = uses + 1 WHERE emoji_id = ? AND remove = ?",
+        (emoji_id, remove),
+    )
+
+
+def count_user_emoji_use(con, user_id, channel, emoji_id, remove):
+    key = (user_id, channel, remove, emoji_id)
+    con.execute(
+        "INSERT OR IGNORE INTO user_emoji_usage "
+        "(user_id, channel, remove, emoji_id, uses) VALUES (?, ?, ?, ?, 0)",
+        key,
+    )
+    con.execute(
+        "UPDATE user_emoji_usage SET uses = uses + 1 "
+        "WHERE user_id = ? AND channel = ? AND remove = ? AND emoji_id = ?",
+        key,
+    )
+
+
+hour_span, day_span = 3600, 86400
+
+# every reaction counts towards channel '', those with a message towards its channel
+channel_sources = [
+    ("''", ""),
+    ("message.channel", "INNER JOIN message ON message.id = reaction.message_id "),
+]
+
+
+def hour(ts):
+    return int(float(ts)) // hour_span * hour_span
+
+
+def add_rollups(con, rows):
+    # rows of (bucket, span, emoji_id, channel, user_id, remove, uses)
+    rows = list(rows)
+    con.executemany(
+        "INSERT OR IGNORE INTO reaction_rollup "
+        "(bucket, span, emoji_id, channel, user_id, remove, uses) "
+        "VALUES (?, ?, ?, ?, ?, ?, 0)",
+        (row[:-1] for row in rows),
+    )
+    con.executemany(
+        "UPDATE reaction_rollup SET uses = uses + ? "
+        "WHERE bucket = ? AND span = ? AND emoji_id = ? AND channel = ? "
+        "AND user_id = ? AND remove = ?",
+        ((row[-1],) + tuple(row[:-1]) for row in rows),
+    )
+
+
+def rebuild_rollups(con):
+    con.execute("DELETE FROM reaction_rollup")
+    for channel_column, join in channel_sources:
+        con.execute(
+            "INSERT INTO reaction_rollup "
+            "(bucket, span, emoji_id, channel, user_id, remove, uses) "
+            "SELECT CAST(reaction.timestamp AS INTEGER) "
+            f"- CAST(reaction.timestamp AS INTEGER) % {hour_span}, {hour_span}, "
+            f"reaction.emoji_id, {channel_column}, reaction.user_id, "
+            "reaction.remove, count(*) "
+            f"FROM reaction {join}"
+            "WHERE reaction.emoji_id IS NOT NULL AND reaction.user_id IS NOT NULL "
+            f"AND reaction.emoji_id NOT IN {removed_emoji_ids} "
+            "GROUP BY 1, 3, 4, 5, 6"
+        )
+
+
+def compact_rollups(con, before):
+    # fold hourly buckets older than `before` into daily ones
+    cutoff = int(before) // day_span * day_span
+    rows = con.execute(
+        f"SELECT bucket - bucket % {day_span}, {day_span}, emoji_id, channel, "
+        "user_id, remove, sum(uses) FROM reaction_rollup "
+        "WHERE span = ? AND bucket < ? "
+        "GROUP BY 1, emoji_id, channel, user_id, remove",
+        (hour_span, cutoff),
+    ).fetchall()
+    add_rollups(con, rows)
+    con.execute(
+        "DELETE FROM reaction_rollup WHERE span = ? AND bucket < ?",
+        (hour_span, cutoff),
+    )
+    return len(rows)
+
+
+def rebuild_emoji_usage(con):
+    con.execute("DELETE FROM emoji_usage")
+    return con.execute(
+        "INSERT INTO emoji_usage (emoji_id, remove, uses) "
+        "SELECT emoji_id, remove, count(*) FROM reaction "
+        f"WHERE emoji_id IS NOT NULL AND emoji_id NOT IN {removed_emoji_ids} "
+        "GROUP BY emoji_id, remove"
+    ).rowcount
+
+
+def rebuild_user_emoji_usage(con):
+    con.execute("DELETE FROM user_emoji_usage")
+    return sum(
+        con.execute(
+            "INSERT INTO user_emoji_usage (user_id, channel, remove, emoji_id, uses) "
+            f"SELECT reaction.user_id, {channel_column}, reaction.remove, "
+            f"reaction.emoji_id, count(*) FROM reaction {join}"
+            "WHERE reaction.emoji_id IS NOT NULL AND reaction.user_id IS NOT NULL "
+            f"AND reaction.emoji_id NOT IN {removed_emoji_ids} "
+            "GROUP BY 1, 2, 3, 4"
+        ).rowcount
+        for channel_column, join in channel_sources
+    )
+
+
+def verify_emoji_usage(con):
+    # rows of (emoji_id, remove, counted uses, actual uses) that disagree
+    return con.execute(
+        "SELECT emoji_id, remove, sum(counted), sum(actual) FROM ("
+        "SELECT emoji_id, remove, uses AS counted, 0 AS actual FROM emoji_usage "
+        "UNION ALL "
+        "SELECT emoji_id, remove, 0, count(*) FROM reaction "
+        f"WHERE emoji_id IS NOT NULL AND emoji_id NOT IN {removed_emoji_ids} "
+        "GROUP BY emoji_id, remove) "
+        "GROUP BY emoji_id, remove "
+        "HAVING sum(counted) != sum(actual)"
+    ).fetchall()
+
+
 def update_reaction_with_message(con, reaction_id, message_id):
-    res = con.execute(
-        "UPDATE reaction SET message_id = ? WHERE id = ?;", (message_id, reaction_id)
+    reaction = con.execute(
+        "SELECT timestamp, emoji_id, user_id, remove FROM reaction "
+        "WHERE id = ? AND message_id IS NULL",
+        (reaction_id,),
     ).fetchall()
-    con.commit()
-    return res
+    channel = get_message_channel(con, message_id)
+    if reaction and channel and reaction[0][1] is not None:
+        ts, emoji_id, user_id, remove = reaction[0]
+        add_rollups(con, [(hour(ts), hour_span, emoji_id, channel, user_id, remove, 1)])
+        count_user_emoji_use(con, user_id, channel, emoji_id, remove)
+    con.execute(
+        "UPDATE reaction SET message_id = ? WHERE id = ?;", (message_id, reaction_id)
+    )
+    # the uses an already analysed message adds, for the app's leaderboards
+    if not reaction:
+        return []
+    return _sentiment_uses(con, "AND reaction.id = ? ", (reaction_id,)).fetchall()
 
 
 def top_n_emojis(con, n, remove):
     return con.execute(
-        "SELECT count(name) as uses, name FROM emoji "
-        "INNER JOIN reaction ON emoji.id = reaction.emoji_id "
-        "WHERE remove = ? "
-        "GROUP BY name "
+        "SELECT uses, name FROM emoji_usage "
+        "INNER JOIN emoji ON emoji.id = emoji_usage.emoji_id "
+        "WHERE remove = ? AND emoji.removed IS NULL "
         "ORDER BY uses DESC "
         "LIMIT ?",
         (remove, n),
     ).fetchall()
 
 
+def top_n_emojis_since(con, n, remove, since, channel=None):
+    return con.execute(
+        "SELECT sum(uses) as total, emoji.name FROM reaction_rollup "
+        "INNER JOIN emoji ON emoji.id = reaction_rollup.emoji_id "
+        "WHERE channel = ? AND remove = ? AND bucket >= ? AND emoji.removed IS NULL "
+        "GROUP BY emoji.name "
+        "ORDER BY total DESC "
+        "LIMIT ?",
+        (channel or "", remove, since, n),
+    ).fetchall()
+
+
+def top_n_emojis_by_user_since(con, n, user, remove, since, channel=None):
+    return con.execute(
+        "SELECT sum(uses) as total, emoji.name FROM reaction_rollup "
+        "INNER JOIN emoji ON emoji.id = reaction_rollup.emoji_id "
+        "WHERE user_id = (SELECT id FROM slack_user WHERE slack_user_id = ?) "
+        "AND channel = ? AND remove = ? AND bucket >= ? AND emoji.removed IS NULL "
+        "GROUP BY emoji.name "
+        "ORDER BY total DESC "
+        "LIMIT ?",
+        (user, channel or "", remove, since, n),
+    ).fetchall()
+
+
 def top_n_recent(con, n):
     return con.execute(
         "SELECT name, first_used_created, MAX(timestamp = first_used_created) as used "
         "FROM emoji "
         "LEFT JOIN reaction ON reaction.emoji_id = emoji.id "
+        "WHERE emoji.removed IS NULL "
         "GROUP BY name, first_used_created "
         "ORDER BY first_used_created DESC "
         "LIMIT ?",
@@ -222,149 +830,613 @@ def top_n_recent(con, n):
     ).fetchall()
 
 
-def top_n_positive_emojis(con, n, remove):
+def top_n_sentiment_emojis(con, n, remove, sentiment):
     return con.execute(
         "SELECT count(emoji.name) as uses, emoji.name "
         "FROM analysis "
-        "INNER JOIN message ON analysis.message_id = message.id "
-        "INNER JOIN reaction ON reaction.message_id = message.id "
+        "INNER JOIN reaction ON reaction.message_id = analysis.message_id "
         "INNER JOIN emoji ON reaction.emoji_id = emoji.id "
         "WHERE reaction.remove = ? "
-        "AND json_extract(\"result\", '$.compound') >= 0.05 "
+        "AND analysis.sentiment = ? "
+        "AND emoji.removed IS NULL "
         "GROUP BY emoji.name "
         "ORDER BY uses DESC "
         "LIMIT ?",
-        (remove, n),
+        (remove, sentiment, n),
     ).fetchall()
 
 
+def top_n_positive_emojis(con, n, remove):
+    return top_n_sentiment_emojis(con, n, remove, 1)
+
+
 def top_n_neutral_emojis(con, n, remove):
-    return con.execute(
-        "SELECT count(emoji.name) as uses, emoji.name "
-        "FROM analysis "
-        "INNER JOIN message ON analysis.message_id = message.id "
-        "INNER JOIN reaction ON reaction.message_id = message.id "
-        "INNER JOIN emoji ON reaction.emoji_id = emoji.id "
-        "WHERE reaction.remove = ? "
-        "AND json_extract(\"result\", '$.compound') < 0.05 "
-        "AND json_extract(\"result\", '$.compound') > -0.05 "
-        "GROUP BY emoji.name "
-        "ORDER BY uses DESC "
-        "LIMIT ?",
-        (remove, n),
-    ).fetchall()
+    return top_n_sentiment_emojis(con, n, remove, 0)
 
 
 def top_n_negative_emojis(con, n, remove):
+    return top_n_sentiment_emojis(con, n, remove, -1)
+
+
+def top_n_emojis_by_sentiment(con, n, remove):
+    # every bucket in one call, {sentiment: [(uses, name), ...]}. A query per
+    # bucket keeps each one on the analysis_sentiment index, a single grouped
+    # query over all buckets scans every reaction and is twice as slow
+    return {
+        sentiment: top_n_sentiment_emojis(con, n, remove, sentiment)
+        for sentiment in sentiments
+    }
+
+
+def top_n_emojis_by_user(con, n, user, remove, channel=None):
     return con.execute(
-        "SELECT count(emoji.name) as uses, emoji.name "
-        "FROM analysis "
-        "INNER JOIN message ON analysis.message_id = message.id "
-        "INNER JOIN reaction ON reaction.message_id = message.id "
-        "INNER JOIN emoji ON reaction.emoji_id = emoji.id "
-        "WHERE reaction.remove = ? "
-        "AND json_extract(\"result\", '$.compound') <= -0.05 "
-        "GROUP BY emoji.name "
+        "SELECT uses, emoji.name FROM user_emoji_usage "
+        "INNER JOIN emoji ON emoji.id = user_emoji_usage.emoji_id "
+        "WHERE user_id = (SELECT id FROM slack_user WHERE slack_user_id = ?) "
+        "AND channel = ? AND remove = ? AND emoji.removed IS NULL "
         "ORDER BY uses DESC "
         "LIMIT ?",
-        (remove, n),
+        (user, channel or "", remove, n),
     ).fetchall()
 
 
-def top_n_emojis_by_user(con, n, user, remove, channel=None):
-    query, params = (
-        (
-            "SELECT count(emoji.name) as uses, emoji.name "
-            "FROM emoji "
-            "INNER JOIN reaction ON reaction.emoji_id = emoji.id "
-            "INNER JOIN slack_user ON slack_user.id = reaction.user_id "
-            "INNER JOIN message ON message.id = reaction.message_id "
-            "WHERE slack_user.slack_user_id = ? "
-            "AND reaction.remove = ? "
-            "AND message.channel = ? "
-            "GROUP BY emoji.name "
-            "ORDER BY uses DESC "
-            "LIMIT ?",
-            (user, remove, channel, n),
-        )
-        if channel
-        else (
-            "SELECT count(emoji.name) as uses, emoji.name "
-            "FROM emoji "
-            "INNER JOIN reaction ON reaction.emoji_id = emoji.id "
-            "INNER JOIN slack_user ON slack_user.id = reaction.user_id "
-            "WHERE slack_user.slack_user_id = ? "
-            "AND reaction.remove = ? "
-            "GROUP BY emoji.name "
-            "ORDER BY uses DESC "
-            "LIMIT ?",
-            (user, remove, n),
-        )
-    )
-    return con.execute(query, params).fetchall()
-
-
 def close(con):
+    con.commit()
     con.close()
 
 
+# queries Database.stream can read a chunk at a time, they return a cursor or
+# generator instead of a list
+streams = {
+    "get_emoji_ids_by_names": scan_emoji_ids_by_names,
+    "scan_reactions": scan_reactions,
+    "scan_sentiment_uses": scan_sentiment_uses,
+}
+
+# the streams a worker process has open, by id, as [connection, rows, last read]
+_open_streams = {}
+_stream_ids = count()
+# seconds an unread stream keeps its snapshot, an open snapshot holds back
+# checkpoints of the wal
+stream_idle = 60
+
+
+def open_stream(con, name, *args):
+    query = streams[name]
+    # each stream reads its own snapshot on a read only connection, writes made
+    # while it is read, even by this worker, don't show up in it
+    path = con.execute("PRAGMA database_list").fetchone()[2]
+    stream_con = connect(path, True) if path else con
+    if stream_con is not con:
+        stream_con.execute("BEGIN")
+    stream_id = next(_stream_ids)
+    _open_streams[stream_id] = [
+        stream_con,
+        iter(query(stream_con, *args)),
+        monotonic(),
+    ]
+    return stream_id
+
+
+def fetch_stream(con, stream_id, n):
+    stream = _open_streams[stream_id]
+    rows = list(islice(stream[1], n))
+    stream[2] = monotonic()
+    if len(rows) < n:
+        close_stream(con, stream_id)
+    return rows
+
+
+def close_stream(con, stream_id):
+    stream = _open_streams.pop(stream_id, None)
+    if stream is None:
+        return
+    stream_con, rows, last_read = stream
+    if hasattr(rows, "close"):
+        rows.close()
+    if stream_con is not con:
+        stream_con.close()
+
+
+def expire_streams(con):
+    now = monotonic()
+    for stream_id, (stream_con, rows, last_read) in list(_open_streams.items()):
+        if now - last_read > stream_idle:
+            logging.warning(f"closing stream {stream_id}, unread for {stream_idle}s")
+            close_stream(con, stream_id)
+
+
 options = {
     "insert_reaction": insert_reaction,
     "insert_message": insert_message,
     "insert_emoji_with_name": insert_emoji_with_name,
     "insert_user_with_id": insert_user_with_id,
+    "get_schema_version": get_schema_version,
     "get_emoji_with_name": get_emoji_with_name,
     "get_user_with_id": get_user_with_id,
     "get_message": get_message,
     "get_message_text": get_message_text,
+    "get_unanalysed_messages": get_unanalysed_messages,
+    "get_unanalysed_messages_after": get_unanalysed_messages_after,
+    "get_unanalysed_count": get_unanalysed_count,
     "get_emoji_ids_by_names": get_emoji_ids_by_names,
     "get_model_by_name": get_model_by_name,
     "get_analysis": get_analysis,
+    "get_sentiment_uses_of": get_sentiment_uses_of,
     "delete_emoji_ids": delete_emoji_ids,
+    "purge_removed_emojis": purge_removed_emojis,
+    "get_purge_backlog": get_purge_backlog,
     "top_n_emojis": top_n_emojis,
     "top_n_recent": top_n_recent,
     "top_n_positive_emojis": top_n_positive_emojis,
     "top_n_negative_emojis": top_n_negative_emojis,
     "top_n_neutral_emojis": top_n_neutral_emojis,
+    "top_n_sentiment_emojis": top_n_sentiment_emojis,
+    "top_n_emojis_by_sentiment": top_n_emojis_by_sentiment,
     "top_n_emojis_by_user": top_n_emojis_by_user,
+    "top_n_emojis_since": top_n_emojis_since,
+    "top_n_emojis_by_user_since": top_n_emojis_by_user_since,
     "rename_emoji_with_name": rename_emoji_with_name,
     "update_reaction_with_message": update_reaction_with_message,
     "insert_model": insert_model,
     "insert_analysis": insert_analysis,
+    "insert_analyses": insert_analyses,
+    "insert_analyses_with_uses": insert_analyses_with_uses,
+    "rebuild_emoji_usage": rebuild_emoji_usage,
+    "verify_emoji_usage": verify_emoji_usage,
+    "rebuild_user_emoji_usage": rebuild_user_emoji_usage,
+    "prune_message_text": prune_message_text,
+    "rebuild_rollups": rebuild_rollups,
+    "compact_rollups": compact_rollups,
+    "open_stream": open_stream,
+    "fetch_stream": fetch_stream,
+    "close_stream": close_stream,
     "close": close,
 }
 
 
-def _run_remote_db(name, q, rq):
-    con = sqlite3.connect(name)
-    start_db(con)
+def is_read(name):
+    return name.startswith(("get_", "top_n_", "verify_"))
+
+
+# calls nobody is waiting on, the analyzer and maintenance work
+background_calls = {
+    "get_unanalysed_messages",
+    "get_unanalysed_messages_after",
+    "get_unanalysed_count",
+    "get_purge_backlog",
+    "insert_analysis",
+    "insert_analyses",
+    "insert_analyses_with_uses",
+    "purge_removed_emojis",
+    "rebuild_emoji_usage",
+    "verify_emoji_usage",
+    "rebuild_user_emoji_usage",
+    "prune_message_text",
+    "rebuild_rollups",
+    "compact_rollups",
+    "open_stream",
+    "fetch_stream",
+    "close_stream",
+}
+
+# share of a worker's time each class gets while they all have calls queued
+priority_weights = {"interactive": 8, "ingest": 4, "background": 1}
+
+
+def priority_of(name):
+    # top_n_ calls answer slack shortcuts and commands with a 3s trigger deadline
+    if name.startswith("top_n_"):
+        return "interactive"
+    if name in background_calls:
+        return "background"
+    return "ingest"
+
+
+class _Scheduler:
+    # one queue per priority class, stride scheduled by the time each class has
+    # spent running calls so a class can't starve the ones weighted below it
+    def __init__(self, weights=priority_weights):
+        self.weights = weights
+        self.queues = {priority: deque() for priority in weights}
+        self.passes = dict.fromkeys(weights, 0.0)
+        # pass of the class picked last, only ever grows
+        self.now = 0.0
+
+    def __len__(self):
+        return sum(map(len, self.queues.values()))
+
+    def put(self, priority, item):
+        queue = self.queues[priority]
+        if not queue:
+            # a class doesn't bank the turns it had nothing queued for
+            self.passes[priority] = max(self.passes[priority], self.now)
+        queue.append(item)
+
+    def next(self):
+        return min(
+            (priority for priority, queue in self.queues.items() if queue),
+            key=self.passes.get,
+        )
+
+    def get(self):
+        priority = self.next()
+        self.now = self.passes[priority]
+        return priority, self.queues[priority].popleft()
+
+    def charge(self, priority, elapsed):
+        self.passes[priority] += elapsed / self.weights[priority]
+
+
+def _run_call(con, command, args):
+    # every call of a group commit runs in its own savepoint so a failing call is
+    # undone without undoing the calls before it. The group is an explicit
+    # transaction, releasing an outermost savepoint would commit it
+    if not con.in_transaction:
+        con.execute("BEGIN")
+    con.execute("SAVEPOINT call")
+    try:
+        res = options[command](con, *args)
+    except Exception:
+        try:
+            con.execute("ROLLBACK TO call")
+            con.execute("RELEASE call")
+        except sqlite3.Error:
+            # sqlite already rolled back the whole transaction
+            con.rollback()
+        raise
+    con.execute("RELEASE call")
+    return res
+
+
+def _run_remote_db(
+    name,
+    conn,
+    batch_size=1,
+    batch_delay=0,
+    readonly=False,
+    slow_query=None,
+    purge_batch=500,
+):
+    con = connect(name, readonly)
+    if not readonly:
+        start_db(con)
+    statements = []
+    if slow_query:
+        con.set_trace_callback(statements.append)
 
     def signal_handler(sig, frame):
+        con.commit()
         con.close()
         logging.info("remote db closing down")
         exit()
 
     signal.signal(signal.SIGINT, signal_handler)
-    while True:
-        command = q.get()
-        res = options[command[0]](con, *command[1:])
-        rq.put(res)
-        if command[0] == "close":
-            break
+    # picks up a purge an earlier worker didn't get to finish
+    purging = not readonly and bool(get_purge_backlog(con))
+    scheduler = _Scheduler()
+    # close waits until every call sent before it has run
+    closing = []
+
+    def receive():
+        request = conn.recv()
+        if request[1] == "close":
+            closing.append(request)
+        else:
+            scheduler.put(priority_of(request[1]), request)
+
+    closed = False
+    while not closed:
+        # reactions of removed emoji go in bounded batches while nothing is queued
+        while purging and not scheduler and not conn.poll():
+            try:
+                purging = purge_removed_emojis(con, purge_batch) == purge_batch
+                con.commit()
+            except sqlite3.Error as e:
+                con.rollback()
+                purging = False
+                logging.error(f"Couldn't purge removed emoji: {e}")
+        if not scheduler and not closing:
+            # with streams open wake up now and then to expire abandoned ones
+            if not _open_streams or conn.poll(stream_idle):
+                receive()
+        expire_streams(con)
+        # group commit: run up to batch_size calls, waiting at most batch_delay for
+        # more, in one transaction and reply once it is durable. Whatever has been
+        # sent is queued by class before each call so interactive calls overtake
+        # bulk ones
+        replies = []
+        failed = None
+        deadline = monotonic() + batch_delay
+        while len(replies) < batch_size:
+            while conn.poll():
+                receive()
+            if scheduler:
+                # background calls commit on their own, a slow one never holds up
+                # the replies to a group
+                if replies and scheduler.next() == "background":
+                    break
+                priority, (req_id, command, args) = scheduler.get()
+            elif closing:
+                priority, (req_id, command, args) = "ingest", closing.pop()
+            elif conn.poll(max(0, deadline - monotonic())):
+                continue
+            else:
+                break
+            statements.clear()
+            started = monotonic()
+            try:
+                if readonly or command == "close":
+                    res, err = options[command](con, *args), None
+                else:
+                    res, err = _run_call(con, command, args), None
+            except Exception as e:
+                res, err = None, e
+            elapsed = monotonic() - started
+            scheduler.charge(priority, elapsed)
+            if slow_query and elapsed >= slow_query:
+                logging.warning(
+                    f"slow db call {command}{repr(args)[:500]} took {elapsed:.3f}s: "
+                    + "; ".join(statements)
+                )
+            replies.append((req_id, res, err, started, elapsed))
+            if command == "close":
+                closed = True
+                break
+            if err is not None and not readonly and not con.in_transaction:
+                # the calls before this one were rolled back with it
+                failed = err
+                break
+            purging = purging or command == "delete_emoji_ids"
+            if priority == "background":
+                break
+        if not closed and failed is None:
+            try:
+                con.commit()
+            except sqlite3.Error as e:
+                failed = e
+                try:
+                    con.rollback()
+                except sqlite3.Error:
+                    pass
+        if failed is not None:
+            logging.error(f"db batch of {len(replies)} calls failed: {failed}")
+            replies = [
+                (req_id, None, err or failed, started, elapsed)
+                for req_id, res, err, started, elapsed in replies
+            ]
+        for reply in replies:
+            conn.send(reply)
+
+
+class _Remote:
+    def __init__(self, name, *args):
+        self.conn, remote_conn = Pipe()
+        self.send_lock = Lock()
+        self.pending = {}
+        self.ids = count()
+        self.proc = Process(target=_run_remote_db, args=(name, remote_conn) + args)
+        self.proc.start()
+        remote_conn.close()
+        self.receiver = Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    def _receive(self):
+        while True:
+            try:
+                req_id, res, err, started, elapsed = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            future, name, sent = self.pending.pop(req_id)
+            # monotonic is system wide so the worker's start time is comparable
+            registry.observe("emoji_atlas_db_queue_seconds", started - sent, op=name)
+            registry.observe(
+                "emoji_atlas_db_wait_seconds",
+                started - sent,
+                priority=priority_of(name),
+            )
+            registry.observe("emoji_atlas_db_execute_seconds", elapsed, op=name)
+            if err is None:
+                future.set_result(res)
+            else:
+                future.set_exception(err)
+        for future, name, sent in self.pending.values():
+            future.set_exception(EOFError("remote db exited"))
+
+    def submit(self, name, *args):
+        logging.debug(f"calling {name}")
+        future = Future()
+        with self.send_lock:
+            req_id = next(self.ids)
+            self.pending[req_id] = (future, name, monotonic())
+            self.conn.send((req_id, name, args))
+        return future
 
 
 class Database:
-    def __init__(self, name):
+    def __init__(
+        self,
+        name,
+        batch_size=1,
+        batch_delay=0,
+        readers=0,
+        slow_query=None,
+        team=None,
+        purge_batch=500,
+    ):
         self.name = name
-        self.inq = Manager().Queue()
-        self.rq = Manager().Queue()
-        self.proc = Process(target=_run_remote_db, args=(self.name, self.inq, self.rq))
-        self.proc.start()
+        # bumped after every completed write, lets readers cache derived data
+        self.version = 0
+        self.writer = _Remote(
+            name, batch_size, batch_delay, False, slow_query, purge_batch
+        )
+        # read only connections can only be opened once the writer has migrated
+        self.writer.submit("get_schema_version").result()
+        self.readers = [_Remote(name, 1, 0, True, slow_query) for _ in range(readers)]
+        for worker, remote in [("writer", self.writer)] + [
+            (f"reader{i}", reader) for i, reader in enumerate(self.readers)
+        ]:
+            registry.gauge(
+                "emoji_atlas_db_in_flight",
+                partial(len, remote.pending),
+                worker=worker,
+                **({"team": team} if team else {}),
+            )
+
+    def shard(self, team):
+        # a single db serves every team, see ShardedDatabase
+        return self
+
+    def opened(self, team):
+        return self
+
+    def idle(self):
+        return not any(remote.pending for remote in [self.writer] + self.readers)
+
+    def submit(self, name, *args):
+        if not is_read(name):
+            future = self.writer.submit(name, *args)
+            future.add_done_callback(self._bump_version)
+            return future
+        if self.readers:
+            reader = min(self.readers, key=lambda reader: len(reader.pending))
+            return reader.submit(name, *args)
+        return self.writer.submit(name, *args)
+
+    def stream(self, name, *args, chunk_size=500):
+        # rows of one of the streams pulled chunk_size at a time from a cursor held
+        # open in one worker, the next chunk is fetched while the caller works on
+        # this one. Closing the iterator early closes the cursor
+        remote = (
+            min(self.readers, key=lambda reader: len(reader.pending))
+            if self.readers
+            else self.writer
+        )
+        stream_id = remote.submit("open_stream", name, *args).result()
+        done = False
+        try:
+            fetch = remote.submit("fetch_stream", stream_id, chunk_size)
+            while not done:
+                rows = fetch.result()
+                done = len(rows) < chunk_size
+                if not done:
+                    fetch = remote.submit("fetch_stream", stream_id, chunk_size)
+                yield from rows
+        finally:
+            if not done:
+                try:
+                    remote.submit("close_stream", stream_id)
+                except OSError:
+                    # the worker has exited, its cursors with it
+                    pass
+
+    def _bump_version(self, future):
+        self.version += 1
 
     def _remote_call(self, name, *args):
-        logging.debug(f"calling {name}")
-        self.inq.put([name] + list(args))
-        return self.rq.get()
+        return self.submit(name, *args).result()
+
+    def close(self):
+        for reader in self.readers:
+            reader.submit("close").result()
+        return self.writer.submit("close").result()
+
+    def __getattr__(self, attr):
+        if attr in options:
+            return partial(self._remote_call, attr)
+        raise AttributeError(attr)
+
+
+class ShardedDatabase:
+    # one Database per slack team in its own file, e.g. path="data/{team}.db",
+    # opened on first use and closed once it has gone `idle_timeout` seconds unused
+    def __init__(self, path, idle_timeout=600, **kwargs):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.kwargs = kwargs
+        self.shards = {}
+        self.used = {}
+        self.lock = Lock()
+        registry.gauge("emoji_atlas_db_shards", partial(len, self.shards))
+        Thread(target=self._close_idle, daemon=True).start()
+
+    def shard(self, team):
+        if not team:
+            # would open a file named after None, an event without a team is a bug
+            raise ValueError("no team to pick a db shard for")
+        with self.lock:
+            self.used[team] = monotonic()
+            shard = self.shards.get(team)
+            opening = shard is None
+            if opening:
+                shard = self.shards[team] = Future()
+        if opening:
+            try:
+                shard.set_result(
+                    Database(self.path.format(team=team), team=team, **self.kwargs)
+                )
+            except Exception as e:
+                with self.lock:
+                    del self.shards[team]
+                shard.set_exception(e)
+        return shard.result()
+
+    def opened(self, team):
+        # the team's db if it is already open, None rather than waiting for it
+        with self.lock:
+            shard = self.shards.get(team)
+            if shard is None or not shard.done() or shard.exception():
+                return None
+            self.used[team] = monotonic()
+            return shard.result()
+
+    def _close_idle(self):
+        while True:
+            sleep(min(self.idle_timeout, 60))
+            now = monotonic()
+            with self.lock:
+                idle = [
+                    (team, self.shards.pop(team))
+                    for team, shard in list(self.shards.items())
+                    if now - self.used[team] > self.idle_timeout
+                    and shard.done()
+                    and not shard.exception()
+                    and shard.result().idle()
+                ]
+            for team, shard in idle:
+                logging.info(f"closing idle db for team {team}")
+                shard.result().close()
+
+    def close(self):
+        with self.lock:
+            shards, self.shards = self.shards, {}
+        for shard in shards.values():
+            if shard.done() and not shard.exception():
+                shard.result().close()
+
+
+class AsyncDatabase:
+    # awaitable calls over a Database, replies resolve without blocking the loop
+    def __init__(self, database):
+        self.database = database
+
+    async def _remote_call(self, name, *args):
+        # imported here so only the async app pays for importing asyncio
+        from asyncio import wrap_future
+
+        return await wrap_future(self.database.submit(name, *args))
+
+    async def shard(self, team):
+        # opening a team's db starts its workers and migrates it, off the loop in
+        # a thread, once per idle period
+        database = self.database.opened(team)
+        if database is None:
+            from asyncio import get_running_loop
+
+            database = await get_running_loop().run_in_executor(
+                None, self.database.shard, team
+            )
+        return AsyncDatabase(database)
 
     def __getattr__(self, attr):
         if attr in options:
@@ -1,17 +1,25 @@
 from functools import partial
 from itertools import chain
 from os import environ
-from re import match
+from re import match, search
+from threading import Event
+from time import time
 import sqlite3
 import logging
 import signal
-import json
 
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-
-from db import Database, emoji_user_ts_from_event
+from analysis import Analyzer
+from cache import LRUCache, VersionedCache
+from ingest import Ingest
+from leaderboard import Leaderboards
+from metrics import span, startup_phase, registry, serve
+from db import (
+    Database,
+    ShardedDatabase,
+    emoji_user_ts_from_event,
+    sentiment_bucket,
+    sentiments,
+)
 from views import (
     top_n,
     home_view,
@@ -19,13 +27,62 @@ from views import (
     div,
     emoji_to_line,
     emoji_added,
-    emoji_help_line,
+    emote_view,
+    top_emojis_view,
 )
 
 logging.basicConfig(level=logging.INFO)
 
-database = Database(environ["db_file"])
-app = App(token=environ["bot_token"])
+db_options = dict(
+    batch_size=int(environ.get("db_batch_size", 1)),
+    batch_delay=float(environ.get("db_batch_delay", 0)),
+    readers=int(environ.get("db_readers", 2)),
+    slow_query=float(environ.get("db_slow_query", 0.25)),
+    purge_batch=int(environ.get("db_purge_batch", 500)),
+)
+# db_shards, e.g. "data/{team}.db", gives every workspace its own db file
+with startup_phase("database"):
+    database = (
+        ShardedDatabase(
+            environ["db_shards"], float(environ.get("db_shard_idle", 600)), **db_options
+        )
+        if "db_shards" in environ
+        else Database(environ["db_file"], **db_options)
+    )
+# top emojis per sentiment bucket in memory, emote answers from these
+leaderboards = Leaderboards(
+    int(environ.get("leaderboard_cache_size", 1000)),
+    float(environ.get("leaderboard_check_interval", 600)),
+)
+with startup_phase("leaderboard"):
+    if "db_shards" not in environ:
+        leaderboards.get(database)
+with startup_phase("analyzer"):
+    analyzer = Analyzer(
+        database,
+        processes=int(environ.get("analysis_processes", 1)),
+        on_uses=leaderboards.add,
+    )
+user_ids = LRUCache(int(environ.get("user_cache_size", 10000)))
+emoji_ids = LRUCache(int(environ.get("emoji_cache_size", 10000)))
+message_ids = LRUCache(
+    int(environ.get("message_cache_size", 10000)),
+    float(environ.get("message_cache_ttl", 300)),
+)
+ingest = Ingest(
+    int(environ.get("ingest_workers", 4)),
+    int(environ.get("ingest_queue_size", 1000)),
+    float(environ.get("ingest_dedupe_window", 600)),
+)
+for cache_name, cache in [
+    ("user", user_ids),
+    ("emoji", emoji_ids),
+    ("message", message_ids),
+]:
+    registry.gauge("emoji_atlas_cache_hits", lambda c=cache: c.hits, cache=cache_name)
+    registry.gauge(
+        "emoji_atlas_cache_misses", lambda c=cache: c.misses, cache=cache_name
+    )
 
 
 def signal_handler(sig, frame):
@@ -33,194 +90,277 @@ def signal_handler(sig, frame):
     exit()
 
 
-def add_analysis_to_message(message_id, analysis, model_name):
-    model_id = database.get_model_by_name(model_name) or database.insert_model(
-        model_name
+def team_of(context):
+    # org wide installs of an enterprise grid app have no team
+    return context.get("team_id") or context.get("enterprise_id")
+
+
+def get_user_id(team, user):
+    db = database.shard(team)
+    return user_ids.get_or_load(
+        (team, user),
+        lambda: db.get_user_with_id(user) or db.insert_user_with_id(user),
     )
-    analysis_id = database.get_analysis(message_id, model_id)
-    if not analysis_id:
-        message = database.get_message_text(message_id)
-        result = json.dumps(analysis(message))
-        database.insert_analysis(message_id, model_id, result)
 
 
-def add_message_to_reaction(client, logger, reaction_id, reaction_item):
+def get_emoji_id(team, emoji, ts):
+    db = database.shard(team)
+    return emoji_ids.get_or_load(
+        (team, emoji),
+        lambda: db.get_emoji_with_name(emoji) or db.insert_emoji_with_name(emoji, ts),
+    )
+
+
+def fetch_message_id(team, client, channel, message_ts):
+    db = database.shard(team)
+    # messages are keyed by (channel, ts) so a stored one needs no api call
+    message_id = db.get_message(channel, message_ts)
+    if message_id:
+        return message_id
+    with span("conversations_history"):
+        result = client.conversations_history(
+            channel=channel, inclusive=True, oldest=message_ts, limit=1
+        )
+    message = result["messages"][0]
+    text, user, ts = message["text"], message["user"], message["ts"]
+    message_id = db.insert_message(get_user_id(team, user), channel, text, ts)
+    analyzer.submit(message_id, team)
+    return message_id
+
+
+def add_message_to_reaction(team, client, logger, reaction_id, reaction_item):
     # only care about messages
     if reaction_item["type"] != "message":
         logger.info("Reaction to none message")
         return
     channel, message_ts = reaction_item["channel"], reaction_item["ts"]
     try:
-        result = client.conversations_history(
-            channel=channel, inclusive=True, oldest=message_ts, limit=1
+        message_id = message_ids.get_or_load(
+            (team, channel, message_ts),
+            partial(fetch_message_id, team, client, channel, message_ts),
         )
     except Exception as e:
         logger.info(f"Couldn't retrieve message for reaction {e}")
         return
-    message = result["messages"][0]
-    text, user, ts = message["text"], message["user"], message["ts"]
-    user_id = database.get_user_with_id(user) or database.insert_user_with_id(user)
-    message_id = database.get_message(user_id, text, ts) or database.insert_message(
-        user_id, channel, text, ts
-    )
-    database.update_reaction_with_message(reaction_id, message_id)
+    db = database.shard(team)
+    leaderboards.add(db, db.update_reaction_with_message(reaction_id, message_id))
 
-    add_analysis_to_message(
-        message_id, SentimentIntensityAnalyzer().polarity_scores, "vader"
-    )
 
+def process_reaction(team, remove_flag, logger, body, client):
+    with span("reaction_event"):
+        emoji, user, ts = emoji_user_ts_from_event(body)
+        logger.info(f"reaction: {emoji} by: {user}!")
 
-def reaction_event(remove_flag, logger, ack, body, client):
-    ack()
-    emoji, user, ts = emoji_user_ts_from_event(body)
-    logger.info(f"reaction: {emoji} by: {user}!")
+        user_id = get_user_id(team, user)
+        emoji_id = get_emoji_id(team, emoji, ts)
+        reaction_id = database.shard(team).insert_reaction(
+            user_id, emoji_id, ts, remove_flag
+        )
+        add_message_to_reaction(
+            team, client, logger, reaction_id, body["event"]["item"]
+        )
 
-    user_id = database.get_user_with_id(user) or database.insert_user_with_id(user)
-    emoji_id = database.get_emoji_with_name(emoji) or database.insert_emoji_with_name(
-        emoji, ts
-    )
-    reaction_id = database.insert_reaction(user_id, emoji_id, ts, remove_flag)
-    add_message_to_reaction(client, logger, reaction_id, body["event"]["item"])
+
+def reaction_keys(team, remove_flag, body):
+    # slack retries keep the event_id, socket mode redeliveries keep the content
+    event = body["event"]
+    item = event["item"]
+    return [
+        body.get("event_id"),
+        (
+            team,
+            event["user"],
+            event["reaction"],
+            item.get("channel"),
+            item.get("ts"),
+            event["event_ts"],
+            remove_flag,
+        ),
+    ]
 
 
-app.event("reaction_added")(partial(reaction_event, 0))
-app.event("reaction_removed")(partial(reaction_event, 1))
+def reaction_event(remove_flag, logger, ack, body, client, context):
+    ack()
+    team = team_of(context)
+    ingest.submit(
+        reaction_keys(team, remove_flag, body),
+        process_reaction,
+        team,
+        remove_flag,
+        logger,
+        body,
+        client,
+    )
 
 
-def emoji_remove(names):
-    ids = database.get_emoji_ids_by_names(names)
+def emoji_remove(team, names):
+    db = database.shard(team)
+    ids = db.get_emoji_ids_by_names(names)
     flat_ids = list(chain(*ids))
-    dels = database.delete_emoji_ids(flat_ids)
+    dels = db.delete_emoji_ids(flat_ids)
+    emoji_ids.invalidate(*((team, name) for name in names))
+    leaderboards.remove(db, names)
 
 
-@app.event("emoji_changed")
-def emoji_changed(logger, ack, event):
-    sub_type = event["subtype"]
-    if sub_type == "remove":
-        emoji_remove(event["names"])
-    elif sub_type == "rename":
-        database.rename_emoji_with_name(event["old_name"], event["new_name"])
-    elif sub_type == "add":
-        database.insert_emoji_with_name(event["name"], event["event_ts"])
-    else:
-        raise NotImplementedError(f"Unhandled subtype {event}")
+def emoji_changed(logger, ack, event, context):
+    with span("emoji_changed"):
+        team = team_of(context)
+        db = database.shard(team)
+        sub_type = event["subtype"]
+        if sub_type == "remove":
+            emoji_remove(team, event["names"])
+        elif sub_type == "rename":
+            db.rename_emoji_with_name(event["old_name"], event["new_name"])
+            emoji_ids.invalidate((team, event["old_name"]), (team, event["new_name"]))
+            leaderboards.rename(db, event["old_name"], event["new_name"])
+        elif sub_type == "add":
+            emoji_ids.put(
+                (team, event["name"]),
+                db.insert_emoji_with_name(event["name"], event["event_ts"]),
+            )
+        else:
+            raise NotImplementedError(f"Unhandled subtype {event}")
 
 
-@app.shortcut("emote")
-def emote(client, logger, ack, shortcut):
-    ack()
-    logger.info("Recieved emote request")
-    react_to, channel, ts = (
-        shortcut["message"]["text"],
-        shortcut["channel"]["id"],
-        shortcut["message"]["ts"],
-    )
-    logger.info(f"Message for reaction: {react_to}")
-    sentiment = SentimentIntensityAnalyzer().polarity_scores(react_to)
-    comp = sentiment["compound"]
-    emoji_per_view = 4
-    if comp >= 0.05:
-        emojis = database.top_n_positive_emojis(emoji_per_view, 0)
-        name = "positive"
-    elif comp <= -0.05:
-        emojis = database.top_n_negative_emojis(emoji_per_view, 0)
-        name = "negative"
-    else:
-        emojis = database.top_n_neutral_emojis(emoji_per_view, 0)
-        name = "neutral"
-    client.views_open(
-        trigger_id=shortcut["trigger_id"],
-        view={
-            "type": "modal",
-            "title": {"type": "plain_text", "text": "Emoji help"},
-            "close": {"type": "plain_text", "text": "Close"},
-            "blocks": [
-                mrkdwn_section(
-                    f"That message seems to express {name} sentiment,"
-                    " one of these emojis would work well as a reaction!"
-                ),
-                top_n(emojis, emoji_help_line),
-            ],
-        },
+def emote(client, logger, ack, shortcut, context):
+    with span("emote"):
+        ack()
+        logger.info("Recieved emote request")
+        react_to, channel, ts = (
+            shortcut["message"]["text"],
+            shortcut["channel"]["id"],
+            shortcut["message"]["ts"],
+        )
+        logger.info(f"Message for reaction: {react_to}")
+        sentiment = analyzer.score(react_to)
+        bucket = sentiment_bucket(sentiment["compound"])
+        emoji_per_view = 4
+        emojis = leaderboards.get(database.shard(team_of(context))).top(
+            emoji_per_view, bucket
+        )
+        with span("views_open"):
+            client.views_open(
+                trigger_id=shortcut["trigger_id"],
+                view=emote_view(sentiments[bucket], emojis),
+            )
+
+
+def parse_top_emojis_command(text):
+    query_user = match(r"^<@(.*?)[|>]", text.strip())
+    query_channel = match(r"<@.*?> <#(.*?)[|>]", text.strip())
+    query_days = search(r"\s(\d+)d$", text.strip())
+    return (
+        query_user.groups()[0] if query_user else None,
+        query_channel.groups()[0] if query_channel else None,
+        int(query_days.groups()[0]) if query_days else None,
     )
 
 
-@app.command("/top-emojis")
-def show_user_top_emoji(ack, logger, command, client):
-    ack()
-    query_user = match(r"^<@(.*?)[|>]", command["text"].strip())
-    query_channel = match(r"<@.*?> <#(.*?)[|>]", command["text"].strip())
-    channel = query_channel.groups()[0] if query_channel else None
-    channel_text = f" in <#{channel}>" if channel else ""
+def top_emojis_for_command(database, user, channel, days):
+    if not user:
+        return []
+    if days:
+        since = time() - days * 86400
+        return database.top_n_emojis_by_user_since(10, user, 0, since, channel)
+    return database.top_n_emojis_by_user(10, user, 0, channel)
+
+
+def show_user_top_emoji(ack, logger, command, client, context):
+    with span("show_user_top_emoji"):
+        ack()
+        user, channel, days = parse_top_emojis_command(command["text"])
+        emojis = top_emojis_for_command(
+            database.shard(team_of(context)), user, channel, days
+        )
+        with span("views_open"):
+            client.views_open(
+                trigger_id=command["trigger_id"],
+                view=top_emojis_view(user, channel, emojis, days),
+            )
+
+
+def build_home_view(team):
+    db = database.shard(team)
     emoji_uses = partial(emoji_to_line, "Uses")
-    blocks = (
-        [
-            mrkdwn_section(f"Top Emojis for <@{query_user.groups()[0]}>{channel_text}"),
-            top_n(
-                database.top_n_emojis_by_user(10, query_user.groups()[0], 0, channel),
-                emoji_uses,
-            ),
-        ]
-        if query_user
-        else [mrkdwn_section("No user found in command")]
-    )
-    client.views_open(
-        trigger_id=command["trigger_id"],
-        view={
-            "type": "modal",
-            "title": {"type": "plain_text", "text": "Top Emojis"},
-            "close": {"type": "plain_text", "text": "Close"},
-            "blocks": blocks,
-        },
+    top_10_emojis = top_n(db.top_n_emojis(10, 0), emoji_uses)
+    top_10_remove = top_n(db.top_n_emojis(10, 1), partial(emoji_to_line, "Removals"))
+    top_10_recent = top_n(db.top_n_recent(10), emoji_added)
+    by_sentiment = db.top_n_emojis_by_sentiment(10, 0)
+    top_10_positive = top_n(by_sentiment[1], emoji_uses)
+    top_10_negative = top_n(by_sentiment[-1], emoji_uses)
+    top_10_neutral = top_n(by_sentiment[0], emoji_uses)
+    return home_view(
+        extra_blocks=(
+            [
+                mrkdwn_section("Most used Emoji"),
+                top_10_emojis,
+                div,
+                mrkdwn_section("Most removed Emoji"),
+                top_10_remove,
+                div,
+                mrkdwn_section("Most recently added or first used"),
+                top_10_recent,
+                div,
+                mrkdwn_section("Top reactions for positive messages"),
+                top_10_positive,
+                div,
+                mrkdwn_section("Top reactions for negative messages"),
+                top_10_negative,
+                div,
+                mrkdwn_section("Top reactions for neutral messages"),
+                top_10_neutral,
+            ]
+        )
     )
 
 
-@app.event("app_home_opened")
-def home_tab(client, event, logger):
-    logger.info("Home page visited")
-    emoji_uses = partial(emoji_to_line, "Uses")
-    top_10_emojis = top_n(database.top_n_emojis(10, 0), emoji_uses)
-    top_10_remove = top_n(
-        database.top_n_emojis(10, 1), partial(emoji_to_line, "Removals")
+home_views = LRUCache(int(environ.get("home_cache_size", 1000)))
+
+
+def home_views_for(team):
+    return home_views.get_or_load(
+        team,
+        lambda: VersionedCache(
+            partial(build_home_view, team),
+            lambda: database.shard(team).version,
+            float(environ.get("home_refresh_interval", 30)),
+        ),
     )
-    top_10_recent = top_n(database.top_n_recent(10), emoji_added)
-    top_10_positive = top_n(database.top_n_positive_emojis(10, 0), emoji_uses)
-    top_10_negative = top_n(database.top_n_negative_emojis(10, 0), emoji_uses)
-    top_10_neutral = top_n(database.top_n_neutral_emojis(10, 0), emoji_uses)
-    try:
-        client.views_publish(
-            user_id=event["user"],
-            view=home_view(
-                extra_blocks=(
-                    [
-                        mrkdwn_section("Most used Emoji"),
-                        top_10_emojis,
-                        div,
-                        mrkdwn_section("Most removed Emoji"),
-                        top_10_remove,
-                        div,
-                        mrkdwn_section("Most recently added or first used"),
-                        top_10_recent,
-                        div,
-                        mrkdwn_section("Top reactions for positive messages"),
-                        top_10_positive,
-                        div,
-                        mrkdwn_section("Top reactions for negative messages"),
-                        top_10_negative,
-                        div,
-                        mrkdwn_section("Top reactions for neutral messages"),
-                        top_10_neutral,
-                    ]
-                )
-            ),
-        )
-    except Exception as e:
-        logger.error(f"Error publishing home tab: {e}")
+
+
+def home_tab(client, event, logger, context):
+    with span("home_tab"):
+        logger.info("Home page visited")
+        view = home_views_for(team_of(context)).get()
+        try:
+            with span("views_publish"):
+                client.views_publish(user_id=event["user"], view=view)
+        except Exception as e:
+            logger.error(f"Error publishing home tab: {e}")
+
+
+def create_app():
+    # bolt is only imported by the apps that use it, it is slow to import
+    from slack_bolt import App
+
+    app = App(token=environ["bot_token"])
+    app.event("reaction_added")(partial(reaction_event, 0))
+    app.event("reaction_removed")(partial(reaction_event, 1))
+    app.event("emoji_changed")(emoji_changed)
+    app.shortcut("emote")(emote)
+    app.command("/top-emojis")(show_user_top_emoji)
+    app.event("app_home_opened")(home_tab)
+    return app
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
-    SocketModeHandler(
-        app,
-        environ["app_token"],
-    ).start()
+    if "metrics_port" in environ:
+        serve(int(environ["metrics_port"]))
+    with startup_phase("app"):
+        from slack_bolt.adapter.socket_mode import SocketModeHandler
+
+        handler = SocketModeHandler(create_app(), environ["app_token"])
+    with startup_phase("connect"):
+        handler.connect()
+    Event().wait()
@@ -0,0 +1,173 @@
+from argparse import ArgumentParser
+from zipfile import ZipFile
+from os import environ, path
+import logging
+import json
+
+from db import (
+    connect,
+    start_db,
+    get_message,
+    insert_message,
+    insert_emoji_with_name,
+    rebuild_emoji_usage,
+    rebuild_user_emoji_usage,
+    rebuild_rollups,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def create_import_tables(con):
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS import_progress( "
+        "archive TEXT, "
+        "member TEXT, "
+        "PRIMARY KEY (archive, member));"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS import_deferred_index( "
+        "name TEXT PRIMARY KEY, "
+        "sql TEXT);"
+    )
+
+
+def defer_indexes(con):
+    # reaction indexes are rebuilt once at the end instead of on every insert,
+    # their definitions are kept in the db so an interrupted import can resume
+    for name, sql in con.execute(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type = 'index' AND tbl_name = 'reaction' AND sql IS NOT NULL"
+    ).fetchall():
+        con.execute(
+            "INSERT OR REPLACE INTO import_deferred_index (name, sql) VALUES (?, ?)",
+            (name, sql),
+        )
+        con.execute(f"DROP INDEX {name}")
+    con.commit()
+
+
+def restore_indexes(con):
+    for name, sql in con.execute(
+        "SELECT name, sql FROM import_deferred_index"
+    ).fetchall():
+        logging.info(f"building index {name}")
+        con.execute(sql)
+        con.execute("DELETE FROM import_deferred_index WHERE name = ?", (name,))
+    con.commit()
+
+
+class Ids:
+    # slack user and emoji ids, loaded once and filled as the import finds more
+    def __init__(self, con):
+        self.con = con
+        self.users = dict(con.execute("SELECT slack_user_id, id FROM slack_user"))
+        self.emojis = dict(con.execute("SELECT name, id FROM emoji"))
+
+    def user(self, slack_user_id):
+        if slack_user_id not in self.users:
+            self.users[slack_user_id] = self.con.execute(
+                "INSERT INTO slack_user (slack_user_id) VALUES (?)", (slack_user_id,)
+            ).lastrowid
+        return self.users[slack_user_id]
+
+    def emoji(self, name, ts):
+        if name not in self.emojis:
+            self.emojis[name] = insert_emoji_with_name(self.con, name, ts)
+        return self.emojis[name]
+
+
+def import_messages(con, ids, channel, messages):
+    reactions = []
+    for message in messages:
+        if "user" not in message or "ts" not in message:
+            continue
+        text, ts = message.get("text", ""), message["ts"]
+        user_id = ids.user(message["user"])
+        # messages already in the atlas had their reactions recorded live
+        if get_message(con, channel, ts):
+            continue
+        message_id = insert_message(con, user_id, channel, text, ts)
+        for reaction in message.get("reactions", []):
+            emoji_id = ids.emoji(reaction["name"], ts)
+            reactions.extend(
+                (ids.user(user), message_id, emoji_id, ts, 0)
+                for user in reaction["users"]
+            )
+    con.executemany(
+        "INSERT INTO reaction (user_id, message_id, emoji_id, timestamp, remove) "
+        "VALUES (?, ?, ?, ?, ?)",
+        reactions,
+    )
+    return len(reactions)
+
+
+def import_export(con, export_path):
+    archive = path.basename(export_path)
+    create_import_tables(con)
+    done = {
+        member
+        for member, in con.execute(
+            "SELECT member FROM import_progress WHERE archive = ?", (archive,)
+        )
+    }
+    with ZipFile(export_path) as export:
+        members = export.namelist()
+        channels = (
+            {c["name"]: c["id"] for c in json.load(export.open("channels.json"))}
+            if "channels.json" in members
+            else {}
+        )
+        ids = Ids(con)
+        if "users.json" in members:
+            for user in json.load(export.open("users.json")):
+                ids.user(user["id"])
+        todo = [
+            member
+            for member in members
+            if "/" in member and member.endswith(".json") and member not in done
+        ]
+        if todo:
+            defer_indexes(con)
+        # one transaction per channel day, committed with its progress marker
+        total = 0
+        for i, member in enumerate(todo, 1):
+            with export.open(member) as f:
+                messages = json.load(f)
+            channel_name = member.rpartition("/")[0]
+            total += import_messages(
+                con, ids, channels.get(channel_name, channel_name), messages
+            )
+            con.execute(
+                "INSERT INTO import_progress (archive, member) VALUES (?, ?)",
+                (archive, member),
+            )
+            con.commit()
+            if i % 100 == 0:
+                logging.info(f"{i}/{len(todo)} files, {total} reactions")
+    restore_indexes(con)
+    rebuild_emoji_usage(con)
+    rebuild_user_emoji_usage(con)
+    rebuild_rollups(con)
+    con.commit()
+    logging.info(f"imported {total} reactions from {archive}")
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Import a Slack workspace export zip, run while the bot is "
+        "stopped. Rerunning with the same export resumes an interrupted import."
+    )
+    parser.add_argument("export")
+    parser.add_argument("--db", default=environ.get("db_file"))
+    args = parser.parse_args(argv)
+    con = connect(args.db)
+    start_db(con)
+    try:
+        import_export(con, args.export)
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
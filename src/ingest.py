@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from time import monotonic
+import logging
+
+from metrics import registry
+
+
+class Dedupe:
+    # remembers keys for `window` seconds, evicting the oldest as time passes
+    def __init__(self, window=600):
+        self.window = window
+        self.expiry = OrderedDict()
+        self.lock = Lock()
+
+    def seen(self, keys):
+        keys = [key for key in keys if key is not None]
+        now = monotonic()
+        with self.lock:
+            while self.expiry and next(iter(self.expiry.values())) < now:
+                self.expiry.popitem(last=False)
+            if any(key in self.expiry for key in keys):
+                return True
+            for key in keys:
+                self.expiry[key] = now + self.window
+            return False
+
+
+class Ingest:
+    # bounded work queue between the bolt handlers and the db, handlers ack and
+    # enqueue, a fixed pool of workers does the db and slack api calls
+    def __init__(self, workers=4, maxsize=1000, window=600):
+        self.queue = Queue(maxsize)
+        self.dedupe = Dedupe(window)
+        self.workers = [Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        registry.gauge("emoji_atlas_ingest_depth", self.queue.qsize)
+
+    def submit(self, keys, work, *args):
+        if self.dedupe.seen(keys):
+            registry.inc("emoji_atlas_ingest_duplicates")
+            logging.info(f"Dropping duplicate event {keys}")
+            return
+        # bolt acks events before the handler runs so slack won't resend a lost
+        # one, a full queue blocks the handler thread instead
+        if self.queue.full():
+            registry.inc("emoji_atlas_ingest_blocked")
+        self.queue.put((monotonic(), work, args))
+        registry.inc("emoji_atlas_ingest_enqueued")
+
+    def _run(self):
+        while True:
+            queued, work, args = self.queue.get()
+            registry.observe("emoji_atlas_ingest_wait_seconds", monotonic() - queued)
+            try:
+                work(*args)
+            except Exception as e:
+                logging.error(f"Couldn't process event: {e}")
@@ -0,0 +1,229 @@
+from collections import Counter
+from heapq import nlargest
+from threading import Thread, Lock
+from time import sleep
+import logging
+
+from cache import LRUCache
+from metrics import registry
+from db import sentiments
+
+
+class Leaderboard:
+    # uses of every emoji per sentiment bucket, counted like top_n_sentiment_emojis,
+    # with the top `size` of each bucket kept sorted so reads don't sort at all
+    def __init__(self, rows=(), size=10):
+        self.size = size
+        self.lock = Lock()
+        self.uses = {sentiment: Counter() for sentiment in sentiments}
+        self.tops = {sentiment: [] for sentiment in sentiments}
+        # emoji changed while a check scans the db, None when no check is running
+        self.touched = None
+        # uses added while a load reads the db, None when no load is running
+        self.added = None
+        self.add(rows)
+
+    def _rank(self, sentiment):
+        counts = self.uses[sentiment]
+        self.tops[sentiment] = nlargest(
+            self.size, ((uses, name) for name, uses in counts.items() if uses > 0)
+        )
+
+    def add(self, rows):
+        with self.lock:
+            for sentiment, name, uses in rows:
+                counts = self.uses[sentiment]
+                counts[name] += uses
+                if self.touched is not None:
+                    self.touched.add(name)
+                if self.added is not None:
+                    self.added[sentiment][name] += uses
+                # counts only grow here, so only this emoji can move into the top
+                top = [entry for entry in self.tops[sentiment] if entry[1] != name]
+                if len(top) < self.size or (counts[name], name) > top[-1]:
+                    top.append((counts[name], name))
+                    top.sort(reverse=True)
+                self.tops[sentiment] = top[: self.size]
+
+    def remove(self, names):
+        with self.lock:
+            for sentiment, counts in self.uses.items():
+                for name in names:
+                    counts.pop(name, None)
+                    if self.added is not None:
+                        self.added[sentiment].pop(name, None)
+                self._rank(sentiment)
+            if self.touched is not None:
+                self.touched.update(names)
+
+    def rename(self, old_name, new_name):
+        with self.lock:
+            for sentiment, counts in self.uses.items():
+                if old_name in counts:
+                    counts[new_name] += counts.pop(old_name)
+                if self.added is not None and old_name in self.added[sentiment]:
+                    added = self.added[sentiment]
+                    added[new_name] += added.pop(old_name)
+                self._rank(sentiment)
+            if self.touched is not None:
+                self.touched.update((old_name, new_name))
+
+    def top(self, n, sentiment):
+        if n <= self.size:
+            return self.tops[sentiment][:n]
+        with self.lock:
+            counts = self.uses[sentiment]
+            return nlargest(
+                n, ((uses, name) for name, uses in counts.items() if uses > 0)
+            )
+
+    def watch(self):
+        # records the emoji updated and the uses added from here on, until the
+        # next recount
+        with self.lock:
+            self.touched = set()
+            self.added = {sentiment: Counter() for sentiment in sentiments}
+
+    def _recount(self, rows, names=None):
+        # sets the counts of `names`, every emoji when None, to those in rows plus
+        # the uses added since watch(). Only an update committed before rows were
+        # read but added after watch() is counted twice. Returns the emoji updated
+        fresh = {sentiment: Counter() for sentiment in sentiments}
+        try:
+            for sentiment, name, uses in rows:
+                fresh[sentiment][name] += uses
+        except BaseException:
+            with self.lock:
+                self.touched = self.added = None
+            raise
+        with self.lock:
+            for sentiment, counts in self.uses.items():
+                added = self.added[sentiment]
+                for name in (
+                    set(counts) | set(fresh[sentiment]) if names is None else names
+                ):
+                    counts[name] = fresh[sentiment][name] + added[name]
+                    if not counts[name]:
+                        del counts[name]
+                self._rank(sentiment)
+            touched = self.touched
+            self.touched = self.added = None
+        return touched
+
+    def load(self, rows, recount, rounds=3):
+        # fills a board watched since before rows, a full scan, were read. Updates
+        # keep coming during the scan, so the emoji they touch are recounted with
+        # recount(names) until a recount sees no update to them, which sets them
+        # exactly. Any left after `rounds` are off by at most the updates in flight
+        # as their last recount started, the next check sets them right
+        touched = self._recount(rows)
+        for _ in range(rounds):
+            if not touched:
+                return
+            self.watch()
+            touched = self._recount(recount(sorted(touched)), touched)
+
+    def check(self, rows):
+        # rows of a fresh scan_sentiment_uses, read outside the lock. Emoji that
+        # changed meanwhile may or may not be in the scan so they are skipped,
+        # anything else that differs has drifted and is set to the db's count
+        with self.lock:
+            self.touched = set()
+        fresh = {sentiment: Counter() for sentiment in sentiments}
+        try:
+            for sentiment, name, uses in rows:
+                fresh[sentiment][name] += uses
+        except BaseException:
+            with self.lock:
+                self.touched = None
+            raise
+        mismatches = 0
+        with self.lock:
+            for sentiment, counts in self.uses.items():
+                drifted = [
+                    name
+                    for name in set(counts) | set(fresh[sentiment])
+                    if name not in self.touched
+                    and counts[name] != fresh[sentiment][name]
+                ]
+                for name in drifted:
+                    logging.warning(
+                        f"leaderboard {sentiments[sentiment]} :{name}: counted "
+                        f"{counts[name]}, db has {fresh[sentiment][name]}"
+                    )
+                    counts[name] = fresh[sentiment][name]
+                    if not counts[name]:
+                        del counts[name]
+                if drifted:
+                    self._rank(sentiment)
+                mismatches += len(drifted)
+            self.touched = None
+        return mismatches
+
+
+class Leaderboards:
+    # a Leaderboard per Database, loaded on first use and checked against the db
+    # every `interval` seconds
+    def __init__(self, maxsize=1000, interval=600, size=10):
+        self.boards = LRUCache(maxsize)
+        self.interval = interval
+        self.size = size
+        # boards still being loaded, they take updates but aren't read yet
+        self.loading = {}
+        registry.gauge("emoji_atlas_leaderboards", lambda: len(self.boards.entries))
+        Thread(target=self._check, daemon=True).start()
+
+    def get(self, database):
+        return self.boards.get_or_load(database, lambda: self._load(database))
+
+    def _load(self, database):
+        board = Leaderboard((), self.size)
+        board.watch()
+        self.loading[database] = board
+        try:
+            board.load(
+                database.stream("scan_sentiment_uses"), database.get_sentiment_uses_of
+            )
+            # cached before it stops being loading, so no update misses it
+            self.boards.put(database, board)
+            return board
+        finally:
+            del self.loading[database]
+
+    def loaded(self, database):
+        return self.boards.get(database)
+
+    def _updated(self, database):
+        # updates go to loaded boards and those being loaded, a later load reads
+        # them from the db. loading is looked at first as a board leaves it last
+        return self.loading.get(database) or self.boards.get(database)
+
+    def add(self, database, rows):
+        board = self._updated(database)
+        if board and rows:
+            board.add(rows)
+
+    def remove(self, database, names):
+        board = self._updated(database)
+        if board:
+            board.remove(names)
+
+    def rename(self, database, old_name, new_name):
+        board = self._updated(database)
+        if board:
+            board.rename(old_name, new_name)
+
+    def _check(self):
+        while True:
+            sleep(self.interval)
+            for database, board in self.boards.items():
+                try:
+                    mismatches = board.check(database.stream("scan_sentiment_uses"))
+                except (EOFError, OSError):
+                    # a shard closed for being idle, it is reloaded on next use
+                    self.boards.invalidate(database)
+                    continue
+                except Exception as e:
+                    logging.error(f"Couldn't check leaderboard: {e}")
+                    continue
+                registry.inc("emoji_atlas_leaderboard_mismatches", mismatches)
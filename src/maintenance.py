@@ -0,0 +1,127 @@
+from argparse import ArgumentParser
+from os import environ
+import logging
+
+from time import time
+from glob import glob
+
+from db import (
+    connect,
+    start_db,
+    rebuild_emoji_usage,
+    rebuild_user_emoji_usage,
+    verify_emoji_usage,
+    rebuild_rollups,
+    compact_rollups,
+    prune_message_text,
+    incremental_vacuum,
+    purge_removed_emojis,
+    get_purge_backlog,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def rebuild_usage(con, args):
+    rows = rebuild_emoji_usage(con)
+    user_rows = rebuild_user_emoji_usage(con)
+    con.commit()
+    logging.info(f"rebuilt {rows} emoji and {user_rows} user emoji usage counters")
+
+
+def verify_usage(con, args):
+    mismatches = verify_emoji_usage(con)
+    for emoji_id, remove, counted, actual in mismatches:
+        logging.warning(
+            f"emoji {emoji_id} remove={remove}: counted {counted}, actual {actual}"
+        )
+    logging.info(f"{len(mismatches)} emoji usage counters out of date")
+    return 1 if mismatches else 0
+
+
+def rebuild_rollup(con, args):
+    rebuild_rollups(con)
+    con.commit()
+    logging.info("rebuilt reaction rollups")
+
+
+def compact_rollup(con, args):
+    rows = compact_rollups(con, time() - args.keep_days * 86400)
+    con.commit()
+    logging.info(f"compacted hourly rollups into {rows} daily rows")
+
+
+def prune_messages(con, args):
+    rows = prune_message_text(con, time() - args.keep_days * 86400)
+    con.commit()
+    logging.info(f"dropped the text of {rows} analysed messages")
+    logging.info(f"freed {incremental_vacuum(con)} pages")
+
+
+def purge_emojis(con, args):
+    for emoji_id, removed, reactions in get_purge_backlog(con):
+        logging.info(f"emoji {emoji_id} removed at {removed}: {reactions} reactions")
+    purged = 0
+    while True:
+        batch = purge_removed_emojis(con, 10000)
+        con.commit()
+        purged += batch
+        logging.info(f"purged {purged} rows")
+        if batch < 10000:
+            return
+
+
+def vacuum(con, args):
+    # converts a db created before incremental vacuum, rewrites the whole file
+    con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    con.execute("VACUUM")
+    logging.info("vacuumed")
+
+
+commands = {
+    "rebuild-emoji-usage": rebuild_usage,
+    "verify-emoji-usage": verify_usage,
+    "rebuild-rollups": rebuild_rollup,
+    "compact-rollups": compact_rollup,
+    "prune-messages": prune_messages,
+    "purge-emojis": purge_emojis,
+    "vacuum": vacuum,
+}
+
+
+def run(db, command, args):
+    con = connect(db)
+    start_db(con)
+    try:
+        return commands[command](con, args) or 0
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Emoji atlas db maintenance")
+    parser.add_argument("command", choices=commands)
+    parser.add_argument("--db", default=environ.get("db_file"))
+    parser.add_argument(
+        "--shards",
+        help="run against every team's db, e.g. 'data/{team}.db', instead of --db",
+    )
+    parser.add_argument(
+        "--keep-days",
+        type=int,
+        default=30,
+        help="days of hourly rollups or message text left alone by "
+        "compact-rollups and prune-messages",
+    )
+    args = parser.parse_args(argv)
+    if not args.shards:
+        return run(args.db, args.command, args)
+    status = 0
+    for db in sorted(glob(args.shards.format(team="*"))):
+        logging.info(f"{args.command} {db}")
+        status = max(status, run(db, args.command, args))
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,94 @@
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from time import monotonic, sleep
+from os import environ
+from glob import glob
+import logging
+import json
+
+from analysis import _init_analyzer, scorers
+from db import (
+    connect,
+    start_db,
+    get_model_by_name,
+    insert_model,
+    get_unanalysed_messages_after,
+    get_unanalysed_count,
+    insert_analyses,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def chunks(con, model_id, size):
+    after = 0
+    while True:
+        messages = get_unanalysed_messages_after(con, after, model_id, size)
+        if not messages:
+            return
+        yield messages
+        after = messages[-1][0]
+
+
+def reanalyse(con, model_name, pool, chunk_size=500, pause=0.1):
+    # every message without an analysis by the model, so a rerun resumes
+    model_id = get_model_by_name(con, model_name) or insert_model(con, model_name)
+    con.commit()
+    score = scorers[model_name]
+    total = get_unanalysed_count(con, model_id)
+    logging.info(f"{total} messages to analyse with {model_name}")
+    done, begin, scoring = 0, monotonic(), None
+
+    def write(ids, scores):
+        insert_analyses(
+            con, [(i, model_id, json.dumps(s)) for i, s in zip(ids, scores.get())]
+        )
+        # short transactions with a pause between them leave room for the bot
+        con.commit()
+        sleep(pause)
+        return len(ids)
+
+    # the pool scores the next chunk while the last one is written
+    for messages in chunks(con, model_id, chunk_size):
+        ids, texts = zip(*messages)
+        pending = (ids, pool.map_async(score, texts))
+        if scoring:
+            done += write(*scoring)
+            logging.info(
+                f"{done}/{total} messages, {done / (monotonic() - begin):.0f}/s"
+            )
+        scoring = pending
+    if scoring:
+        done += write(*scoring)
+    logging.info(f"analysed {done} messages with {model_name}")
+    return done
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Score every message a model hasn't analysed yet, safe to run "
+        "alongside the bot and to rerun after an interruption."
+    )
+    parser.add_argument("--model", choices=scorers, default="vader")
+    parser.add_argument("--db", default=environ.get("db_file"))
+    parser.add_argument("--shards", help="every team's db, e.g. 'data/{team}.db'")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument(
+        "--pause", type=float, default=0.1, help="seconds to sleep between chunks"
+    )
+    args = parser.parse_args(argv)
+    dbs = sorted(glob(args.shards.format(team="*"))) if args.shards else [args.db]
+    _init_analyzer()
+    with Pool(args.processes, initializer=_init_analyzer) as pool:
+        for db in dbs:
+            con = connect(db)
+            start_db(con)
+            try:
+                reanalyse(con, args.model, pool, args.chunk_size, args.pause)
+            finally:
+                con.close()
+
+
+if __name__ == "__main__":
+    main()
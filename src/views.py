@@ -1,4 +1,5 @@
 from itertools import starmap
+from functools import partial
 from datetime import datetime
 
 div = {"type": "divider"}
@@ -48,3 +49,39 @@ def mrkdwn(text):
 def top_n(entries, to_line):
     fields = list(map(mrkdwn, starmap(to_line, enumerate(entries, 1))))
     return {"type": "section", "fields": fields if fields else [mrkdwn("Nothing yet!")]}
+
+
+def modal(title, blocks):
+    return {
+        "type": "modal",
+        "title": {"type": "plain_text", "text": title},
+        "close": {"type": "plain_text", "text": "Close"},
+        "blocks": blocks,
+    }
+
+
+def emote_view(sentiment_name, emojis):
+    return modal(
+        "Emoji help",
+        [
+            mrkdwn_section(
+                f"That message seems to express {sentiment_name} sentiment,"
+                " one of these emojis would work well as a reaction!"
+            ),
+            top_n(emojis, emoji_help_line),
+        ],
+    )
+
+
+def top_emojis_view(user, channel, emojis, days=None):
+    if not user:
+        return modal("Top Emojis", [mrkdwn_section("No user found in command")])
+    channel_text = f" in <#{channel}>" if channel else ""
+    days_text = f" in the last {days} days" if days else ""
+    return modal(
+        "Top Emojis",
+        [
+            mrkdwn_section(f"Top Emojis for <@{user}>{channel_text}{days_text}"),
+            top_n(emojis, partial(emoji_to_line, "Uses")),
+        ],
+    )
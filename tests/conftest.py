@@ -0,0 +1,5 @@
+from os import path
+import sys
+
+# the app runs from src/ with its modules at the top level
+sys.path.insert(0, path.join(path.dirname(__file__), "..", "src"))
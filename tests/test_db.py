@@ -0,0 +1,180 @@
+import json
+
+import pytest
+
+import db
+from db import (
+    connect,
+    start_db,
+    migrations,
+    get_schema_version,
+    insert_user_with_id,
+    insert_emoji_with_name,
+    insert_message,
+    insert_reaction,
+    insert_model,
+    insert_analysis,
+    insert_analyses_with_uses,
+    update_reaction_with_message,
+    get_message,
+    prune_message_text,
+    get_analysis,
+    get_sentiment_uses_of,
+    top_n_emojis,
+    top_n_emojis_by_user,
+    top_n_sentiment_emojis,
+    top_n_emojis_by_sentiment,
+)
+
+
+@pytest.fixture
+def con():
+    con = connect(":memory:")
+    start_db(con)
+    user_id = insert_user_with_id(con, "U1")
+    emoji_id = insert_emoji_with_name(con, "tada", 1.0)
+    message_id = insert_message(con, user_id, "C1", "great news", "1.0")
+    reaction_id = insert_reaction(con, user_id, emoji_id, 1.0, 0)
+    update_reaction_with_message(con, reaction_id, message_id)
+    model_id = insert_model(con, "vader")
+    insert_analysis(con, message_id, model_id, json.dumps({"compound": 0.9}))
+    yield con
+    con.close()
+
+
+def plans(con, query, *args):
+    # the query plan of every SELECT query runs, one list of steps per statement
+    statements = []
+    con.set_trace_callback(statements.append)
+    query(con, *args)
+    con.set_trace_callback(None)
+    return [
+        [detail for *_, detail in con.execute("EXPLAIN QUERY PLAN " + sql)]
+        for sql in statements
+        if sql.lstrip().upper().startswith("SELECT")
+    ]
+
+
+def assert_searches(con, query, *args, using=()):
+    steps = [step for plan in plans(con, query, *args) for step in plan]
+    assert steps
+    assert not [step for step in steps if step.startswith("SCAN")], steps
+    for index in using:
+        assert any(f"INDEX {index} " in step for step in steps), steps
+
+
+def test_get_message(con):
+    assert get_message(con, "C1", "1.0") == 1
+    assert_searches(con, get_message, "C1", "1.0", using=["message_channel_ts"])
+
+
+def test_get_analysis(con):
+    assert get_analysis(con, 1, 1) == 1
+    assert_searches(con, get_analysis, 1, 1, using=["analysis_message_model"])
+
+
+def test_top_n_emojis(con):
+    assert top_n_emojis(con, 10, 0) == [(1, "tada")]
+    assert_searches(con, top_n_emojis, 10, 0, using=["emoji_usage_top"])
+
+
+@pytest.mark.parametrize("channel", [None, "C1"])
+def test_top_n_emojis_by_user(con, channel):
+    assert top_n_emojis_by_user(con, 10, "U1", 0, channel) == [(1, "tada")]
+    assert_searches(
+        con,
+        top_n_emojis_by_user,
+        10,
+        "U1",
+        0,
+        channel,
+        using=["user_emoji_usage_top"],
+    )
+
+
+def test_top_n_sentiment_emojis(con):
+    assert top_n_sentiment_emojis(con, 4, 0, 1) == [(1, "tada")]
+    assert top_n_sentiment_emojis(con, 4, 0, -1) == []
+    assert_searches(
+        con,
+        top_n_sentiment_emojis,
+        4,
+        0,
+        1,
+        using=["analysis_sentiment", "reaction_message"],
+    )
+
+
+def test_top_n_emojis_by_sentiment(con):
+    assert top_n_emojis_by_sentiment(con, 10, 0) == {1: [(1, "tada")], 0: [], -1: []}
+    for plan in plans(con, top_n_emojis_by_sentiment, 10, 0):
+        assert any("INDEX analysis_sentiment " in step for step in plan), plan
+    assert_searches(con, top_n_emojis_by_sentiment, 10, 0)
+
+
+def test_insert_analyses_with_uses(con):
+    message_id = insert_message(con, 1, "C1", "awful news", "2.0")
+    reaction_id = insert_reaction(con, 1, 1, 2.0, 0)
+    update_reaction_with_message(con, reaction_id, message_id)
+    analyses = [(message_id, 1, json.dumps({"compound": -0.9}))]
+    assert insert_analyses_with_uses(con, analyses) == [(-1, "tada", 1)]
+    assert_searches(
+        con, insert_analyses_with_uses, analyses, using=["reaction_message"]
+    )
+
+
+def test_get_sentiment_uses_of(con):
+    assert get_sentiment_uses_of(con, ["tada", "missing"]) == [(1, "tada", 1)]
+    assert_searches(con, get_sentiment_uses_of, ["tada"], using=["reaction_emoji"])
+
+
+def test_update_reaction_with_message(con):
+    reaction_id = insert_reaction(con, 1, 1, 3.0, 0)
+    assert update_reaction_with_message(con, reaction_id, 1) == [(1, "tada", 1)]
+    # attaching it again adds nothing
+    assert update_reaction_with_message(con, reaction_id, 1) == []
+    reaction_id = insert_reaction(con, 1, 1, 4.0, 0)
+    assert_searches(con, update_reaction_with_message, reaction_id, 1)
+
+
+def test_failed_migration_rolls_back(monkeypatch):
+    con = connect(":memory:")
+    for migration in migrations[:3]:
+        migration(con)
+    con.execute("PRAGMA user_version = 3")
+    con.execute("INSERT INTO slack_user (slack_user_id) VALUES ('U1')")
+    con.execute("INSERT INTO message (user_id, channel, timestamp) VALUES (1, 'C1', 1)")
+    con.execute("INSERT INTO model (name) VALUES ('vader')")
+    con.execute(
+        "INSERT INTO analysis (message_id, model_id, result) "
+        "VALUES (1, 1, '{\"compound\": 0.9}')"
+    )
+    con.commit()
+
+    def fail(compound):
+        raise ValueError("backfill failed")
+
+    # the backfill of add_analysis_sentiment fails after its ALTER TABLEs
+    monkeypatch.setattr(db, "sentiment_bucket", fail)
+    with pytest.raises(Exception):
+        start_db(con)
+    assert get_schema_version(con) == 3
+    columns = [column for _, column, *_ in con.execute("PRAGMA table_info(analysis)")]
+    assert "compound" not in columns
+    monkeypatch.undo()
+    start_db(con)
+    assert get_schema_version(con) == len(migrations)
+    assert con.execute("SELECT sentiment FROM analysis").fetchall() == [(1,)]
+
+
+def test_prune_message_text():
+    con = connect(":memory:")
+    start_db(con)
+    user_id = insert_user_with_id(con, "U1")
+    message_id = insert_message(con, user_id, "C1", "imported", "1.0")
+    # no model is registered yet, the text is still needed
+    assert prune_message_text(con, 10.0) == 0
+    model_id = insert_model(con, "vader")
+    assert prune_message_text(con, 10.0) == 0
+    insert_analysis(con, message_id, model_id, json.dumps({"compound": 0.1}))
+    assert prune_message_text(con, 10.0) == 1
@@ -0,0 +1,49 @@
+from collections import Counter
+
+from leaderboard import Leaderboards
+
+
+class FakeDatabase:
+    # sentiment uses by (sentiment, name), a write during a scan lands after the
+    # scan's snapshot like it would in a worker
+    def __init__(self, uses, during_scan=()):
+        self.uses = Counter(uses)
+        self.during_scan = list(during_scan)
+
+    def write(self, sentiment, name, uses):
+        self.uses[sentiment, name] += uses
+        return [(sentiment, name, uses)]
+
+    def stream(self, name):
+        assert name == "scan_sentiment_uses"
+        snapshot = sorted(self.uses.items())
+        for i, ((sentiment, name), uses) in enumerate(snapshot):
+            if i == 1:
+                for write in self.during_scan:
+                    write()
+            yield sentiment, name, uses
+
+    def get_sentiment_uses_of(self, names):
+        return [
+            (sentiment, name, uses)
+            for (sentiment, name), uses in self.uses.items()
+            if name in names
+        ]
+
+
+def test_updates_during_load_are_kept():
+    leaderboards = Leaderboards(interval=3600)
+    database = FakeDatabase({(1, "tada"): 5, (1, "wave"): 3, (-1, "sob"): 2})
+    # committed before the scan, but only added to the leaderboards during it
+    committed = database.write(1, "wave", 4)
+    database.during_scan = [
+        lambda: leaderboards.add(database, database.write(1, "tada", 2)),
+        lambda: leaderboards.add(database, database.write(1, "new", 1)),
+        lambda: leaderboards.add(database, committed),
+    ]
+    board = leaderboards.get(database)
+    assert board.top(10, 1) == [(7, "wave"), (7, "tada"), (1, "new")]
+    assert board.top(10, -1) == [(2, "sob")]
+    assert not leaderboards.loading
+    leaderboards.add(database, database.write(1, "wave", 5))
+    assert board.top(1, 1) == [(12, "wave")]